@@ -21,6 +21,7 @@ from libopensesame import item, debug
 from libqtopensesame import qtplugin
 import imp
 import os.path
+import sys
 
 class eyetracker_calibrate(item.item):
 
@@ -57,6 +58,9 @@ class eyetracker_calibrate(item.item):
 		self.cal_target_size = 16
 		self.cal_beep = u'yes'
 		self.force_drift_correct = u'no'
+		self.buffered_sampling = u'no'
+		self.lossless_sampling = u'no'
+		self.velocity_filter = u'no'
 		self.ip = u'127.0.0.1'
 		self.sendport = 4444
 		self.receiveport = 5555
@@ -106,9 +110,12 @@ class eyetracker_calibrate(item.item):
 		else:
 			libname = u'libdummy'
 
-		# dynamically load eyetracker library
-		path = os.path.join(os.path.dirname(__file__), u'trackers', u'%s.py' \
-			% libname)
+		# dynamically load eyetracker library; the trackers directory is added
+		# to the path, so that the libraries can import their shared modules
+		tracker_dir = os.path.join(os.path.dirname(__file__), u'trackers')
+		if tracker_dir not in sys.path:
+			sys.path.append(tracker_dir)
+		path = os.path.join(tracker_dir, u'%s.py' % libname)
 		tracker_module = imp.load_source(libname, path)
 		tracker_class = getattr(tracker_module, libname)
 		
@@ -120,7 +127,10 @@ class eyetracker_calibrate(item.item):
 			data_file=data_file, \
 			saccade_velocity_threshold=self.get(u'sacc_vel_thresh'), \
 			saccade_acceleration_threshold=self.get(u'sacc_acc_thresh'), \
-			force_drift_correct=self.get(u'force_drift_correct')== u'yes'
+			force_drift_correct=self.get(u'force_drift_correct')== u'yes', \
+			buffered=self.get(u'buffered_sampling')== u'yes', \
+			lossless=self.get(u'lossless_sampling')== u'yes', \
+			velocity_filter=self.get(u'velocity_filter')== u'yes'
 			)
 
 		# update cleanup functions
@@ -206,8 +216,17 @@ class qteyetracker_calibrate(eyetracker_calibrate, qtplugin.qtplugin):
 		self._driftwidget = self.add_checkbox_control("force_drift_correct", \
 			"Enable drift correction if disabled (Eyelink 1000)", \
 			tooltip = "Indicates whether drift correction should be enabled, if it is disabled in the Eyelink configuration.")
+		self._bufferwidget = self.add_checkbox_control("buffered_sampling", \
+			"Acquire samples in the background (EyeLink, SMI)", \
+			tooltip = "Indicates whether samples should be collected by a background thread and read from a buffer")
+		self._losslesswidget = self.add_checkbox_control("lossless_sampling", \
+			"Keep every sample (EyeLink, SMI)", \
+			tooltip = "Indicates whether every sample should be kept, rather than only the newest one at each poll")
 		# SMI only
 #		self.add_text("<br><b>SMI only</b>")
+		self._filterwidget = self.add_checkbox_control("velocity_filter", \
+			"Smooth velocity for saccade detection (SMI)", \
+			tooltip = "Indicates whether a Savitzky-Golay filter should be applied to the velocity that is used to detect saccades")
 		self._ipwidget = self.add_line_edit_control("ip", "iViewX IP (SMI)", \
 			tooltip = "iViewX internal IP address")
 		self._sendportwidget = self.add_line_edit_control("sendport", "iViewX send port (SMI)", \
@@ -246,6 +265,11 @@ class qteyetracker_calibrate(eyetracker_calibrate, qtplugin.qtplugin):
 		qtplugin.qtplugin.edit_widget(self)
 		# disable EyeLink and SMI specific widgets
 		self._driftwidget.setDisabled(self.get(u'tracker_type') != self._text_eyelink)
+		self._bufferwidget.setDisabled(self.get(u'tracker_type') not in \
+			[self._text_eyelink, self._text_smi])
+		self._losslesswidget.setDisabled(self.get(u'tracker_type') not in \
+			[self._text_eyelink, self._text_smi])
+		self._filterwidget.setDisabled(self.get(u'tracker_type') != self._text_smi)
 		self._ipwidget.setDisabled(self.get(u'tracker_type') != self._text_smi)
 		self._sendportwidget.setDisabled(self.get(u'tracker_type') != self._text_smi)
 		self._receiveportwidget.setDisabled(self.get(u'tracker_type') != self._text_smi)
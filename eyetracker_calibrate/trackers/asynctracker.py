@@ -0,0 +1,222 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+import threading
+
+# concurrent.futures is part of Python 3; on Python 2, it is provided by the
+# futures backport, which doesn't come with OpenSesame
+try:
+	from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+	raise ImportError(u'asynctracker requires concurrent.futures, which is ' \
+		u'provided by the futures package on Python 2 (pip install futures)')
+
+# asyncio is part of Python 3; on Python 2, the trollius backport provides the
+# same interface
+try:
+	import asyncio
+except ImportError:
+	import trollius as asyncio
+
+class async_tracker:
+
+	"""
+	Makes a tracker object, as created by eyetracker_calibrate, usable from an
+	asyncio event loop. The blocking operations return futures, which can be
+	awaited (or yielded from, in a trollius coroutine), while the actual calls
+	run in a single worker thread. Because there is only one worker, calls to
+	the tracker never overlap, and they are carried out in the order in which
+	they were made. Calibration and drift correction use the display, so they
+	run in the thread of the event loop instead, once the worker is idle. All
+	other attributes are passed on to the tracker, and can be used directly as
+	long as they don't block, such as sample().
+	"""
+
+	def __init__(self, tracker, loop=None):
+
+		"""
+		Constructor.
+
+		Arguments:
+		tracker	--	A libeyelink, libsmi or dummy tracker object, such as #
+					experiment.eyetracker.
+
+		Keyword arguments:
+		loop	--	The event loop, or None for the current event loop. #
+					(default=None)
+		"""
+
+		self.tracker = tracker
+		if loop == None:
+			loop = asyncio.get_event_loop()
+		self.loop = loop
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		# The worker future of the most recent call. Calls are carried out in
+		# order, so the worker is idle once this is done.
+		self.last = None
+
+	def __getattr__(self, name):
+
+		return getattr(self.tracker, name)
+
+	def _call(self, function, *args, **kwargs):
+
+		"""
+		Calls a function in the worker thread.
+
+		Arguments:
+		function	--	The function to call.
+		*args		--	The positional arguments of the function.
+		**kwargs	--	The keyword arguments of the function.
+
+		Returns:
+		A future for the return value of the function.
+		"""
+
+		self.last = self.executor.submit(functools.partial(function, *args, \
+			**kwargs))
+		return asyncio.wrap_future(self.last, loop=self.loop)
+
+	def _call_in_loop(self, function, *args, **kwargs):
+
+		"""
+		Calls a function that uses the display in the thread of the event #
+		loop, which blocks the loop until the function returns. The worker #
+		must be idle, so that the tracker isn't used from two threads at #
+		once.
+
+		Arguments:
+		function	--	The function to call.
+		*args		--	The positional arguments of the function.
+		**kwargs	--	The keyword arguments of the function.
+
+		Returns:
+		A future that is already done, with the return value of the function.
+
+		Exceptions:
+		Raises a RuntimeError if a call in the worker thread hasn't finished.
+		"""
+
+		if self.last != None and not self.last.done():
+			raise RuntimeError(u'async_tracker: wait for (or cancel) the ' \
+				u'pending calls before calibrating')
+		future = asyncio.Future(loop=self.loop)
+		try:
+			future.set_result(function(*args, **kwargs))
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	def start_recording(self):
+
+		"""
+		See start_recording() of the tracker.
+
+		Returns:
+		A future that is done when recording has started.
+		"""
+
+		return self._call(self.tracker.start_recording)
+
+	def stop_recording(self):
+
+		"""
+		See stop_recording() of the tracker.
+
+		Returns:
+		A future that is done when recording has stopped.
+		"""
+
+		return self._call(self.tracker.stop_recording)
+
+	def calibrate(self, *args, **kwargs):
+
+		"""
+		See calibrate() of the tracker. The calibration uses the display, so #
+		it runs in the thread of the event loop, which it blocks until the #
+		calibration is finished.
+
+		Returns:
+		A future for the return value of calibrate(), which is already done.
+
+		Exceptions:
+		Raises a RuntimeError if a call in the worker thread hasn't finished.
+		"""
+
+		return self._call_in_loop(self.tracker.calibrate, *args, **kwargs)
+
+	def drift_correction(self, pos=None, fix_triggered=False):
+
+		"""
+		See drift_correction() of the tracker. Like calibrate(), this uses #
+		the display, so it runs in the thread of the event loop.
+
+		Returns:
+		A future for the return value of drift_correction(), which is #
+		already done.
+
+		Exceptions:
+		Raises a RuntimeError if a call in the worker thread hasn't finished.
+		"""
+
+		return self._call_in_loop(self.tracker.drift_correction, pos=pos, \
+			fix_triggered=fix_triggered)
+
+	def next_event(self, events, timeout=None):
+
+		"""
+		Waits for the first of a number of events (see wait_for_any() of the #
+		tracker). Cancelling the future stops the wait, so that the worker #
+		thread becomes available again.
+
+		Arguments:
+		events	--	A list of event codes, such as [5] for STARTSACC.
+
+		Keyword arguments:
+		timeout	--	The maximum waiting time in ms, or None to wait #
+					indefinitely. (default=None)
+
+		Returns:
+		A future for an (event, outcome) tuple as returned by #
+		wait_for_any(), or for None if the timeout expired.
+		"""
+
+		cancelled = threading.Event()
+		future = self._call(self.tracker.wait_for_any, events, \
+			timeout=timeout, abort_check=cancelled.is_set)
+
+		def stop(future):
+			if future.cancelled():
+				cancelled.set()
+
+		future.add_done_callback(stop)
+		return future
+
+	def close(self):
+
+		"""
+		Closes the tracker, and shuts down the worker thread once it is done.
+
+		Returns:
+		A future that is done when the tracker has been closed.
+		"""
+
+		future = self._call(self.tracker.close)
+		future.add_done_callback(lambda future: \
+			self.executor.shutdown(wait=False))
+		return future
@@ -0,0 +1,240 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+
+class clock_model:
+
+	"""
+	A model of the offset between the tracker clock and the experiment clock.
+	The offset (tracker time minus experiment time) is modeled as a constant
+	plus a linear drift, which are fitted to the most recent measurements.
+	Converting timestamps with the model doesn't require any communication with
+	the tracker, and works for single timestamps as well as numpy arrays.
+	"""
+
+	def __init__(self, window=30):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		window	--	The number of most recent measurements that the model is #
+					fitted to. (default=30)
+		"""
+
+		self.measurements = collections.deque(maxlen=window)
+		self.lock = threading.Lock()
+		# The (reference, offset_ref, drift) parameters of the fit are
+		# replaced as a single tuple, so that a conversion never combines
+		# parameters of two different fits
+		self.params = 0, 0, 0
+		self.error = 0
+
+	def add(self, tracker_time, experiment_time, roundtrip=0):
+
+		"""
+		Adds a measurement and refits the model.
+
+		Arguments:
+		tracker_time	--	The tracker time (ms).
+		experiment_time	--	The experiment time (ms) at the same moment, #
+							typically the midpoint of the request.
+
+		Keyword arguments:
+		roundtrip		--	The duration of the request (ms). (default=0)
+		"""
+
+		with self.lock:
+			self.measurements.append((tracker_time, tracker_time - \
+				experiment_time, roundtrip))
+			self._fit()
+
+	def _fit(self):
+
+		"""Fits the offset and drift with least squares."""
+
+		n = len(self.measurements)
+		t = [m[0] for m in self.measurements]
+		o = [m[1] for m in self.measurements]
+		mean_t = sum(t) / float(n)
+		mean_o = sum(o) / float(n)
+		var_t = sum([(ti - mean_t) ** 2 for ti in t])
+		if var_t > 0:
+			drift = sum([(ti - mean_t) * (oi - mean_o) for ti, oi in \
+				zip(t, o)]) / var_t
+		else:
+			drift = 0
+		# The offset is expressed relative to the most recent measurement
+		reference = t[-1]
+		self.params = reference, mean_o + drift * (reference - mean_t), drift
+		# The error combines the scatter of the measurements around the fit
+		# with the uncertainty of the midpoints, which is at most half the
+		# duration of a request
+		residuals = sum([(oi - mean_o - drift * (ti - mean_t)) ** 2 for ti, \
+			oi in zip(t, o)]) / float(n)
+		halfroundtrip = sum([m[2] for m in self.measurements]) / (2. * n)
+		self.error = (residuals + halfroundtrip ** 2) ** .5
+
+	def ready(self):
+
+		"""
+		Returns:
+		True if at least one measurement has been added, False otherwise.
+		"""
+
+		return len(self.measurements) > 0
+
+	def uncertainty(self):
+
+		"""
+		Returns:
+		An estimate of the error of the modeled offset (ms), which combines #
+		the scatter of the measurements around the model with the average #
+		uncertainty of a single measurement (half its roundtrip).
+		"""
+
+		return self.error
+
+	def offset(self, tracker_time=None):
+
+		"""
+		Gets the modeled offset.
+
+		Keyword arguments:
+		tracker_time	--	The tracker time for which the offset is #
+							requested, or None for the time of the most #
+							recent measurement. (default=None)
+
+		Returns:
+		The tracker time minus the experiment time (ms).
+		"""
+
+		reference, offset_ref, drift = self.params
+		if tracker_time is None:
+			return offset_ref
+		return offset_ref + drift * (tracker_time - reference)
+
+	def experiment_time(self, tracker_time):
+
+		"""
+		Converts tracker time to experiment time.
+
+		Arguments:
+		tracker_time	--	A tracker timestamp (ms), or a numpy array of #
+							timestamps.
+
+		Returns:
+		The experiment time (ms).
+		"""
+
+		return tracker_time - self.offset(tracker_time)
+
+	def tracker_time(self, experiment_time):
+
+		"""
+		Converts experiment time to tracker time.
+
+		Arguments:
+		experiment_time	--	An experiment timestamp (ms), or a numpy array #
+							of timestamps.
+
+		Returns:
+		The tracker time (ms).
+		"""
+
+		reference, offset_ref, drift = self.params
+		return (experiment_time + offset_ref - drift * reference) / (1. - \
+			drift)
+
+	def reset(self):
+
+		"""Discards all measurements."""
+
+		with self.lock:
+			self.measurements.clear()
+			self.params = 0, 0, 0
+			self.error = 0
+
+def synchronize(measure, model, n=5):
+
+	"""
+	Discards the measurements of a model, and measures the offset a number of #
+	times in a row. Only the measurement with the shortest roundtrip, which #
+	is the least affected by delays, is added to the model.
+
+	Arguments:
+	measure	--	A function that returns a (tracker_time, experiment_time, #
+				roundtrip) tuple, or None if the measurement failed.
+	model	--	The clock_model to update.
+
+	Keyword arguments:
+	n		--	The number of measurements. (default=5)
+	"""
+
+	model.reset()
+	best = None
+	for i in range(n):
+		m = measure()
+		if m != None and (best == None or m[2] < best[2]):
+			best = m
+	if best != None:
+		model.add(*best)
+
+class clock_sync_thread(threading.Thread):
+
+	"""Periodically measures the clock offset in the background."""
+
+	def __init__(self, measure, model, interval=1.):
+
+		"""
+		Constructor.
+
+		Arguments:
+		measure		--	A function that returns a (tracker_time, #
+						experiment_time, roundtrip) tuple, or None if the #
+						measurement failed.
+		model		--	The clock_model to update.
+
+		Keyword arguments:
+		interval	--	The time between two measurements in seconds. #
+						(default=1.)
+		"""
+
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.measure = measure
+		self.model = model
+		self.interval = interval
+		self.stop_event = threading.Event()
+
+	def run(self):
+
+		"""Measures until stop() is called."""
+
+		while not self.stop_event.wait(self.interval):
+			m = self.measure()
+			if m != None:
+				self.model.add(*m)
+
+	def stop(self):
+
+		"""Stops measuring and waits for the thread to finish."""
+
+		self.stop_event.set()
+		self.join()
@@ -0,0 +1,206 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+import traceback
+import Queue
+
+class event_bus:
+
+	"""
+	Passes detected events on to the callbacks that have subscribed to them.
+	A callback is either called immediately, from the thread that detects the
+	event, or queued until the main loop calls dispatch(). The latter is
+	required for callbacks that draw to the display or otherwise use objects
+	that are not thread-safe.
+	"""
+
+	def __init__(self):
+
+		"""Constructor."""
+
+		self.lock = threading.Lock()
+		self.subscriptions = {}
+		self.queue = Queue.Queue()
+		self.count = 0
+
+	def subscribe(self, event, callback, main_loop=False):
+
+		"""
+		Subscribes a callback to an event.
+
+		Arguments:
+		event		--	An event code, such as STARTSACC.
+		callback	--	A function that is called with the event code and #
+						the outcome of the event, as returned by #
+						wait_for_event(), as arguments.
+
+		Keyword arguments:
+		main_loop	--	Indicates whether the callback should be queued #
+						until dispatch() is called, rather than called from #
+						the detection thread. (default=False)
+
+		Returns:
+		A subscription id, which can be passed to unsubscribe().
+		"""
+
+		with self.lock:
+			self.count += 1
+			self.subscriptions[self.count] = event, callback, main_loop
+			return self.count
+
+	def unsubscribe(self, subscription):
+
+		"""
+		Removes a subscription. Callbacks that have already been queued are #
+		still called by dispatch().
+
+		Arguments:
+		subscription	--	A subscription id from subscribe().
+		"""
+
+		with self.lock:
+			self.subscriptions.pop(subscription, None)
+
+	def events(self):
+
+		"""
+		Returns:
+		A frozenset of the event codes that have subscribers.
+		"""
+
+		with self.lock:
+			return frozenset([s[0] for s in self.subscriptions.values()])
+
+	def publish(self, event, outcome):
+
+		"""
+		Passes an event on to its subscribers. An exception in a callback is #
+		printed, so that it doesn't stop the detection thread.
+
+		Arguments:
+		event	--	An event code.
+		outcome	--	The outcome of the event, as returned by #
+					wait_for_event().
+		"""
+
+		with self.lock:
+			callbacks = [(s[1], s[2]) for s in self.subscriptions.values() \
+				if s[0] == event]
+		for callback, main_loop in callbacks:
+			if main_loop:
+				self.queue.put((callback, event, outcome))
+			else:
+				try:
+					callback(event, outcome)
+				except Exception:
+					print u'eventbus: exception in callback'
+					traceback.print_exc()
+
+	def dispatch(self):
+
+		"""
+		Calls the callbacks that have been queued for the main loop, in the #
+		order in which the events were detected. This should be called #
+		regularly from the main loop, for example between display updates.
+
+		Returns:
+		The number of callbacks that were called.
+		"""
+
+		n = 0
+		while True:
+			try:
+				callback, event, outcome = self.queue.get_nowait()
+			except Queue.Empty:
+				return n
+			callback(event, outcome)
+			n += 1
+
+	def clear(self):
+
+		"""Removes all subscriptions and queued callbacks."""
+
+		with self.lock:
+			self.subscriptions.clear()
+		while True:
+			try:
+				self.queue.get_nowait()
+			except Queue.Empty:
+				return
+
+class detection_thread(threading.Thread):
+
+	"""
+	Feeds samples to event detectors in the background, and publishes the
+	detected events on an event_bus. The detectors belong to the thread, so
+	that they don't interfere with the detectors of the blocking wait_for_*
+	functions.
+	"""
+
+	def __init__(self, read, detectors, bus, outcome, interval=.0005):
+
+		"""
+		Constructor.
+
+		Arguments:
+		read		--	A function that returns the next sample as a #
+						sample_record, or None if no new sample is available.
+		detectors	--	A list of detectors from the eventdetection module.
+		bus			--	The event_bus to publish on.
+		outcome		--	A function that converts an #
+						eventdetection.gaze_event into the outcome that is #
+						passed to the callbacks.
+
+		Keyword arguments:
+		interval	--	The time to sleep when no sample is available, in #
+						seconds. (default=.0005)
+		"""
+
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.read = read
+		self.detectors = detectors
+		self.bus = bus
+		self.outcome = outcome
+		self.interval = interval
+		self.stop_event = threading.Event()
+
+	def run(self):
+
+		"""Detects events until stop() is called."""
+
+		for detector in self.detectors:
+			detector.reset()
+		while not self.stop_event.is_set():
+			s = self.read()
+			if s == None:
+				time.sleep(self.interval)
+				continue
+			events = self.bus.events()
+			for detector in self.detectors:
+				for e in detector.update(s.timestamp, s.x, s.y, s.valid):
+					if e.type in events:
+						self.bus.publish(e.type, self.outcome(e))
+
+	def stop(self):
+
+		"""Stops detecting and waits for the thread to finish."""
+
+		self.stop_event.set()
+		self.join()
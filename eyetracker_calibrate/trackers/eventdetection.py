@@ -0,0 +1,607 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+import numpy
+
+# Event codes, which are the same as the pylink event codes
+STARTBLINK = 3
+ENDBLINK = 4
+STARTSACC = 5
+ENDSACC = 6
+STARTFIX = 7
+ENDFIX = 8
+
+class gaze_event(object):
+
+	"""An event that was detected by an event_detector."""
+
+	__slots__ = ('type', 'timestamp', 'startpos', 'endpos', 'peakvelocity')
+
+	def __init__(self, type, timestamp, startpos, endpos=None, \
+		peakvelocity=None):
+
+		"""
+		Constructor.
+
+		Arguments:
+		type		--	The event code, such as STARTSACC.
+		timestamp	--	The timestamp of the sample at which the event #
+						occurred, which can precede the sample at which it #
+						was detected (e.g. for fixation starts).
+		startpos	--	The (x, y) position at which the saccade or fixation #
+						started.
+
+		Keyword arguments:
+		endpos		--	The (x, y) position at which the saccade or fixation #
+						ended, or None for onsets. (default=None)
+		peakvelocity	--	The highest velocity of a saccade so far, in #
+							the unit of the detector (pixels per sample), #
+							or None for other events. (default=None)
+		"""
+
+		self.type = type
+		self.timestamp = timestamp
+		self.startpos = startpos
+		self.endpos = endpos
+		self.peakvelocity = peakvelocity
+
+	def __repr__(self):
+
+		return u'gaze_event(%s, %s, %s, %s, %s)' % (self.type, \
+			self.timestamp, self.startpos, self.endpos, self.peakvelocity)
+
+def savitzky_golay_coefficients(window, order=2):
+
+	"""
+	Computes Savitzky-Golay coefficients that estimate the first derivative #
+	at the newest of a number of samples, by fitting a polynomial to them. #
+	Because the derivative is estimated at the newest sample, rather than at #
+	the center of the window, the filter doesn't introduce a delay.
+
+	Arguments:
+	window	--	The number of samples that the polynomial is fitted to.
+
+	Keyword arguments:
+	order	--	The order of the polynomial. (default=2)
+
+	Returns:
+	A tuple of coefficients, starting with the one for the oldest sample. #
+	The derivative is in units per sample.
+	"""
+
+	if window <= order:
+		raise ValueError(u'The window must be longer than the order')
+	t = numpy.arange(1 - window, 1, dtype=numpy.float64)
+	design = t[:, numpy.newaxis] ** numpy.arange(order + 1)
+	# The first-order term of the fitted polynomial is the derivative at t=0
+	return tuple([float(c) for c in numpy.linalg.pinv(design)[1]])
+
+class sg_differentiator:
+
+	"""
+	A streaming Savitzky-Golay differentiator, which keeps the most recent
+	samples in a small circular buffer and does O(window) work per sample.
+	"""
+
+	def __init__(self, coefficients):
+
+		"""
+		Constructor.
+
+		Arguments:
+		coefficients	--	The coefficients from #
+							savitzky_golay_coefficients().
+		"""
+
+		self.coefficients = coefficients
+		self.window = len(coefficients)
+		self.xs = [0.] * self.window
+		self.ys = [0.] * self.window
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets all samples."""
+
+		self.head = 0
+		self.n = 0
+
+	def update(self, x, y):
+
+		"""
+		Adds a sample.
+
+		Arguments:
+		x	--	The horizontal gaze position.
+		y	--	The vertical gaze position.
+
+		Returns:
+		An (x, y) tuple with the velocity at this sample in pixels per #
+		sample, or None if fewer samples than the window length have been #
+		added since the last reset.
+		"""
+
+		self.xs[self.head] = x
+		self.ys[self.head] = y
+		self.head += 1
+		if self.head == self.window:
+			self.head = 0
+		if self.n < self.window:
+			self.n += 1
+			if self.n < self.window:
+				return None
+		# The oldest sample is now at the head
+		vx = vy = 0.
+		i = self.head
+		for c in self.coefficients:
+			vx += c * self.xs[i]
+			vy += c * self.ys[i]
+			i += 1
+			if i == self.window:
+				i = 0
+		return vx, vy
+
+class dispersion_window:
+
+	"""
+	The dispersion of the gaze over the most recent samples within a fixed
+	time span. The minimum and maximum positions are kept in monotonic deques,
+	so that adding a sample takes amortized constant time, regardless of how
+	many samples the window contains.
+	"""
+
+	def __init__(self, duration):
+
+		"""
+		Constructor.
+
+		Arguments:
+		duration	--	The time span of the window, in the unit of the #
+						sample timestamps (ms).
+		"""
+
+		self.duration = duration
+		self.clear()
+
+	def clear(self):
+
+		"""Removes all samples from the window."""
+
+		# Each deque holds (timestamp, value) pairs; the values in the max
+		# deques are decreasing and those in the min deques increasing, so
+		# that the extreme is always at the front
+		self.maxx = collections.deque()
+		self.minx = collections.deque()
+		self.maxy = collections.deque()
+		self.miny = collections.deque()
+		self.timestamps = collections.deque()
+		self.first = None
+		self.last = None
+
+	def push(self, timestamp, x, y):
+
+		"""
+		Adds a sample, and removes the samples that have fallen out of the #
+		window.
+
+		Arguments:
+		timestamp	--	The timestamp of the sample.
+		x			--	The horizontal gaze position.
+		y			--	The vertical gaze position.
+		"""
+
+		if self.first == None:
+			self.first = timestamp
+		self.last = timestamp
+		# Values that can no longer be the extreme are dropped from the back
+		while self.maxx and self.maxx[-1][1] <= x:
+			self.maxx.pop()
+		while self.minx and self.minx[-1][1] >= x:
+			self.minx.pop()
+		while self.maxy and self.maxy[-1][1] <= y:
+			self.maxy.pop()
+		while self.miny and self.miny[-1][1] >= y:
+			self.miny.pop()
+		self.maxx.append((timestamp, x))
+		self.minx.append((timestamp, x))
+		self.maxy.append((timestamp, y))
+		self.miny.append((timestamp, y))
+		self.timestamps.append(timestamp)
+		# Samples that have fallen out of the window are dropped from the front
+		oldest = timestamp - self.duration
+		for d in (self.maxx, self.minx, self.maxy, self.miny):
+			while d[0][0] < oldest:
+				d.popleft()
+		while self.timestamps[0] < oldest:
+			self.timestamps.popleft()
+
+	def full(self):
+
+		"""
+		Returns:
+		True if the samples in the window span the full duration, False #
+		otherwise.
+		"""
+
+		return self.first != None and self.last - self.first >= self.duration
+
+	def dispersion(self):
+
+		"""
+		Returns:
+		The diagonal of the bounding box of the samples in the window.
+		"""
+
+		return ((self.maxx[0][1] - self.minx[0][1]) ** 2 + (self.maxy[0][1] - \
+			self.miny[0][1]) ** 2) ** .5
+
+	def start(self):
+
+		"""
+		Returns:
+		The timestamp of the oldest sample in the window.
+		"""
+
+		return self.timestamps[0]
+
+class precision_estimator:
+
+	"""
+	An incremental estimate of the precision of the gaze signal, as the RMS of
+	the distances between consecutive samples (RMS-S2S), separately for the
+	horizontal and vertical direction. The mean and variance of the distances
+	are kept with Welford's algorithm, so that no samples need to be stored.
+	Once memory distances have been added, older distances are gradually
+	forgotten (with exponential weights), so that the estimate follows changes
+	in noise over a session.
+	"""
+
+	def __init__(self, memory=1000, min_count=10):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		memory		--	The number of distances after which older distances #
+						start to be forgotten. (default=1000)
+		min_count	--	The number of distances that is required before the #
+						estimate is used. (default=10)
+		"""
+
+		self.memory = memory
+		self.min_count = min_count
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets all distances."""
+
+		with self.lock:
+			self.count = 0
+			self.mean = [0., 0.]
+			self.var = [0., 0.]
+
+	def add(self, dx, dy):
+
+		"""
+		Adds the distance between two consecutive samples.
+
+		Arguments:
+		dx	--	The horizontal distance.
+		dy	--	The vertical distance.
+		"""
+
+		with self.lock:
+			self.count += 1
+			# With a weight of 1/n, this is Welford's update of the mean and the
+			# (population) variance; with a fixed weight, it is the
+			# exponentially weighted equivalent
+			w = 1. / min(self.count, self.memory)
+			for i, d in enumerate((dx, dy)):
+				delta = d - self.mean[i]
+				self.mean[i] += w * delta
+				self.var[i] = (1 - w) * (self.var[i] + w * delta ** 2)
+
+	def ready(self):
+
+		"""
+		Returns:
+		True if at least min_count distances have been added, False #
+		otherwise.
+		"""
+
+		return self.count >= self.min_count
+
+	def rms(self):
+
+		"""
+		Returns:
+		An (x, y) tuple with the RMS of the distances.
+		"""
+
+		with self.lock:
+			return tuple([(self.var[i] + self.mean[i] ** 2) ** .5 for i in \
+				(0, 1)])
+
+class event_detector:
+
+	"""
+	An incremental saccade and fixation detector, which is fed one sample at a
+	time and does a constant amount of work per sample. Saccades are detected
+	with the Dalmaijer et al. (2013) velocity and acceleration criteria, and
+	fixations with a dispersion criterion over a time window.
+	"""
+
+	def __init__(self, spdtresh, acctresh, fixtresh, dsttresh=None, \
+		weightdist=1, fixduration=50, differentiator=None, precision=None):
+
+		"""
+		Constructor.
+
+		Arguments:
+		spdtresh	--	The saccade velocity threshold in pixels per sample.
+		acctresh	--	The saccade acceleration threshold in pixels per #
+						sample**2.
+		fixtresh	--	The maximum dispersion of a fixation in pixels.
+
+		Keyword arguments:
+		dsttresh	--	An (x, y) tuple with the noise level in pixels. #
+						Movements that are not larger than the noise level #
+						(see weightdist) don't start a saccade. None #
+						disables this check. (default=None)
+		weightdist	--	The weighted distance, in units of the noise level, #
+						that a movement must exceed to start a saccade. #
+						(default=1)
+		fixduration	--	The time span over which the dispersion of a #
+						fixation is determined, in the unit of the sample #
+						timestamps (ms). (default=50)
+		differentiator	--	An sg_differentiator that smooths the velocity, #
+							or None to use the raw distance between #
+							consecutive samples. (default=None)
+		precision	--	A precision_estimator that is updated with the #
+						distances between consecutive samples during #
+						fixations, and that replaces dsttresh once it is #
+						ready, or None to keep dsttresh fixed. The #
+						estimator is reset at the start of every fixation. #
+						(default=None)
+		"""
+
+		self.spdtresh = spdtresh
+		self.acctresh = acctresh
+		self.fixtresh = fixtresh
+		self.dsttresh = dsttresh
+		self.weightdist = weightdist
+		self.fixduration = fixduration
+		self.differentiator = differentiator
+		self.precision = precision
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets all samples, so that detection starts from scratch."""
+
+		self.prevpos = None
+		self.speed = 0
+		self.saccadic = False
+		self.saccadestart = None
+		self.peakvelocity = 0
+		self.fixating = False
+		self.fixationstart = None
+		self.fixwindow = dispersion_window(self.fixduration)
+		if self.differentiator != None:
+			self.differentiator.reset()
+
+	def update(self, timestamp, x, y, valid=True):
+
+		"""
+		Processes a new sample.
+
+		Arguments:
+		timestamp	--	The timestamp of the sample.
+		x			--	The horizontal gaze position.
+		y			--	The vertical gaze position.
+
+		Keyword arguments:
+		valid		--	Indicates whether the sample contains valid data. #
+						Invalid samples (e.g. during blinks) interrupt the #
+						velocity and dispersion calculations. (default=True)
+
+		Returns:
+		A list of gaze_events that were detected at this sample, which is #
+		usually empty. A STARTSACC event has the timestamp of the first #
+		sample that exceeded the thresholds, and a STARTFIX event that of #
+		the oldest sample in the window over which the dispersion was #
+		determined, rather than that of the current sample. Saccade events #
+		carry the peak velocity since the start of the saccade.
+		"""
+
+		if not valid:
+			self.prevpos = None
+			self.speed = 0
+			self.fixwindow.clear()
+			if self.differentiator != None:
+				self.differentiator.reset()
+			return []
+		events = []
+		pos = x, y
+		prevpos = self.prevpos
+		# Saccades; the movement per sample is either smoothed or the raw
+		# distance to the previous sample
+		if self.differentiator != None:
+			movement = self.differentiator.update(x, y)
+		elif self.prevpos != None:
+			movement = x - self.prevpos[0], y - self.prevpos[1]
+		else:
+			movement = None
+		if movement != None and self.prevpos != None:
+			sx, sy = movement
+			s1 = (sx ** 2 + sy ** 2) ** .5 # speed in pixels/sample
+			a = s1 - self.speed # acceleration in pixels/sample**2
+			if not self.saccadic:
+				if self._exceeds_noise(sx, sy) and (s1 > self.spdtresh or \
+					a > self.acctresh):
+					self.saccadic = True
+					self.saccadestart = self.prevpos
+					self.peakvelocity = s1
+					events.append(gaze_event(STARTSACC, timestamp, \
+						self.prevpos, peakvelocity=s1))
+			elif s1 < self.spdtresh and -self.acctresh < a < 0:
+				self.saccadic = False
+				events.append(gaze_event(ENDSACC, timestamp, \
+					self.saccadestart, pos, peakvelocity=self.peakvelocity))
+			else:
+				self.peakvelocity = max(self.peakvelocity, s1)
+			self.speed = s1
+		self.prevpos = pos
+		# Fixations
+		if self.fixating:
+			if ((x - self.fixationstart[0]) ** 2 + (y - \
+				self.fixationstart[1]) ** 2) ** .5 > self.fixtresh:
+				self.fixating = False
+				self.fixwindow.clear()
+				events.append(gaze_event(ENDFIX, timestamp, \
+					self.fixationstart, pos))
+			elif self.precision != None and prevpos != None and not \
+				self.saccadic and (x - prevpos[0]) ** 2 + (y - prevpos[1]) ** 2 \
+				< self.spdtresh ** 2:
+				# The noise level is estimated from the movement during
+				# fixations, so that it follows changes over a session. The
+				# first samples of a saccade can still be within the fixation,
+				# so movements that are saccadic or faster than the velocity
+				# threshold are left out.
+				self.precision.add(x - prevpos[0], y - prevpos[1])
+				if self.precision.ready():
+					rms = self.precision.rms()
+					if rms[0] > 0 and rms[1] > 0:
+						self.dsttresh = rms
+		if not self.fixating:
+			self.fixwindow.push(timestamp, x, y)
+			if self.fixwindow.full() and self.fixwindow.dispersion() < \
+				self.fixtresh:
+				self.fixating = True
+				self.fixationstart = pos
+				# Until the estimate for this fixation is ready, the previous
+				# estimate is kept as the noise level
+				if self.precision != None:
+					self.precision.reset()
+				events.append(gaze_event(STARTFIX, self.fixwindow.start(), \
+					pos))
+		return events
+
+	def _exceeds_noise(self, sx, sy):
+
+		"""
+		Checks whether a movement is larger than the noise level.
+
+		Arguments:
+		sx	--	The horizontal movement in pixels.
+		sy	--	The vertical movement in pixels.
+
+		Returns:
+		True if the movement exceeds the noise level, or if no noise level #
+		has been specified, False otherwise.
+		"""
+
+		if self.dsttresh == None:
+			return True
+		return (sx / self.dsttresh[0]) ** 2 + (sy / self.dsttresh[1]) ** 2 \
+			> self.weightdist
+
+class blink_detector:
+
+	"""
+	An incremental blink detector, which tracks runs of missing data and does
+	a constant amount of work per sample. A run of missing data is a blink if
+	it lasts at least min_duration; runs that last longer than max_duration are
+	considered data loss rather than blinks.
+	"""
+
+	def __init__(self, min_duration=50, max_duration=500):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		min_duration	--	The minimum duration of a blink (ms). #
+							(default=50)
+		max_duration	--	The maximum duration of a blink (ms). #
+							(default=500)
+		"""
+
+		self.min_duration = min_duration
+		self.max_duration = max_duration
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets all samples, so that detection starts from scratch."""
+
+		self.prevpos = None
+		self.runstart = None
+		self.blinking = False
+		self.lost = False
+
+	def update(self, timestamp, x, y, valid=True):
+
+		"""
+		Processes a new sample.
+
+		Arguments:
+		timestamp	--	The timestamp of the sample.
+		x			--	The horizontal gaze position.
+		y			--	The vertical gaze position.
+
+		Keyword arguments:
+		valid		--	Indicates whether the sample contains valid data. #
+						(default=True)
+
+		Returns:
+		A list of gaze_events that were detected at this sample, which is #
+		usually empty. A STARTBLINK event is reported once the run of #
+		missing data has lasted min_duration, and its timestamp is that of #
+		the first missing sample. An ENDBLINK event has the timestamp of the #
+		first valid sample after the blink. Both events have the last valid #
+		position before the blink as startpos, and ENDBLINK has the first #
+		valid position after the blink as endpos.
+		"""
+
+		if not valid:
+			if self.runstart == None:
+				self.runstart = timestamp
+			if not self.lost:
+				duration = timestamp - self.runstart
+				if duration > self.max_duration:
+					# Too long for a blink, so no end will be reported
+					self.lost = True
+					self.blinking = False
+				elif not self.blinking and duration >= self.min_duration:
+					self.blinking = True
+					return [gaze_event(STARTBLINK, self.runstart, \
+						self.prevpos)]
+			return []
+		events = []
+		if self.blinking:
+			events.append(gaze_event(ENDBLINK, timestamp, self.prevpos, \
+				(x, y)))
+		self.runstart = None
+		self.blinking = False
+		self.lost = False
+		self.prevpos = x, y
+		return events
@@ -0,0 +1,184 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import numpy
+
+# The layout of a stored event. The time is the tracker timestamp of the event
+# (ms), by which the events are sorted, and exptime is the same moment in
+# experiment time. The start and end times, positions (pixels), average pupil
+# size and peak velocity (degrees per second) are NaN for events that don't
+# have them, such as the start of a blink.
+STORED_EVENT_DTYPE = numpy.dtype([
+	('type', numpy.int16),
+	('eye', numpy.int8),
+	('time', numpy.float64),
+	('exptime', numpy.float64),
+	('start', numpy.float64),
+	('end', numpy.float64),
+	('startx', numpy.float64),
+	('starty', numpy.float64),
+	('endx', numpy.float64),
+	('endy', numpy.float64),
+	('meanx', numpy.float64),
+	('meany', numpy.float64),
+	('pupil', numpy.float64),
+	('peakvelocity', numpy.float64)
+	])
+
+class event_store:
+
+	"""
+	A history of events, which are kept in one growing array per event type,
+	sorted by time. Time-range queries and lookups of the most recent event
+	before a moment are binary searches, so their cost doesn't grow with the
+	length of a session.
+	"""
+
+	def __init__(self, chunk=4096):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		chunk	--	The number of events by which the array for an event #
+					type grows when it is full. (default=4096)
+		"""
+
+		self.chunk = chunk
+		self.data = {}
+		self.counts = {}
+		self.lock = threading.Lock()
+
+	def push(self, record):
+
+		"""
+		Adds an event.
+
+		Arguments:
+		record	--	A tuple in the STORED_EVENT_DTYPE layout.
+		"""
+
+		type = record[0]
+		t = record[2]
+		with self.lock:
+			if type not in self.data:
+				self.data[type] = numpy.zeros(self.chunk, \
+					dtype=STORED_EVENT_DTYPE)
+				self.counts[type] = 0
+			data = self.data[type]
+			n = self.counts[type]
+			if n == len(data):
+				grown = numpy.zeros(n + self.chunk, dtype=STORED_EVENT_DTYPE)
+				grown[:n] = data
+				self.data[type] = data = grown
+			# Events nearly always arrive in order, so this is usually an
+			# append
+			if n == 0 or data['time'][n - 1] <= t:
+				i = n
+			else:
+				i = numpy.searchsorted(data['time'][:n], t, side='right')
+				data[i + 1:n + 1] = data[i:n]
+			data[i] = record
+			self.counts[type] = n + 1
+
+	def _types(self, types):
+
+		"""
+		Arguments:
+		types	--	A list of event types, or None for all types.
+
+		Returns:
+		The types for which events have been stored.
+		"""
+
+		if types == None:
+			return list(self.data.keys())
+		return [type for type in types if type in self.data]
+
+	def events(self, types=None, since=None, until=None):
+
+		"""
+		Gets the events within a time range.
+
+		Keyword arguments:
+		types	--	A list of event types, or None for all types. #
+					(default=None)
+		since	--	A time (ms). Only events that are more recent are #
+					returned, or None for no limit. (default=None)
+		until	--	A time (ms). Only events that occurred before are #
+					returned, or None for no limit. (default=None)
+
+		Returns:
+		An array in the STORED_EVENT_DTYPE layout, sorted by time.
+		"""
+
+		parts = []
+		with self.lock:
+			for type in self._types(types):
+				data = self.data[type][:self.counts[type]]
+				first = 0
+				last = len(data)
+				if since != None:
+					first = numpy.searchsorted(data['time'], since, \
+						side='right')
+				if until != None:
+					last = numpy.searchsorted(data['time'], until, side='left')
+				parts.append(data[first:last])
+		if len(parts) == 0:
+			return numpy.zeros(0, dtype=STORED_EVENT_DTYPE)
+		events = numpy.concatenate(parts)
+		if len(parts) > 1:
+			events = events[numpy.argsort(events['time'], kind='mergesort')]
+		return events
+
+	def last(self, types=None, before=None):
+
+		"""
+		Gets the most recent event.
+
+		Keyword arguments:
+		types	--	A list of event types, or None for all types. #
+					(default=None)
+		before	--	A time (ms). Only events that occurred before are #
+					considered, or None for no limit. (default=None)
+
+		Returns:
+		An event in the STORED_EVENT_DTYPE layout, or None if there is no #
+		such event.
+		"""
+
+		best = None
+		with self.lock:
+			for type in self._types(types):
+				data = self.data[type]
+				i = self.counts[type]
+				if before != None:
+					i = numpy.searchsorted(data['time'][:i], before, \
+						side='left')
+				if i > 0 and (best is None or data[i - 1]['time'] > \
+					best['time']):
+					best = data[i - 1].copy()
+		return best
+
+	def clear(self):
+
+		"""Removes all events, without releasing their memory."""
+
+		with self.lock:
+			for type in self.counts:
+				self.counts[type] = 0
@@ -0,0 +1,291 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+# Offline fixation and saccade classification of recorded samples, such as
+# those returned by get_samples(). All functions operate on complete arrays in
+# the samplebuffer.SAMPLE_DTYPE layout, without looping over samples in Python.
+
+# The layout of a detected fixation or saccade. Times are in the same clock as
+# the sample timestamps (ms), positions in pixels and the peak velocity in
+# degrees per second. The start and end indices refer to the sample array, and
+# the end index is exclusive.
+EVENT_DTYPE = numpy.dtype([
+	('startindex', numpy.int64),
+	('endindex', numpy.int64),
+	('start', numpy.float64),
+	('end', numpy.float64),
+	('duration', numpy.float64),
+	('startx', numpy.float64),
+	('starty', numpy.float64),
+	('endx', numpy.float64),
+	('endy', numpy.float64),
+	('meanx', numpy.float64),
+	('meany', numpy.float64),
+	('peakvelocity', numpy.float64)
+	])
+
+def tracker_thresholds(tracker):
+
+	"""
+	Gets the saccade thresholds that were passed to a tracker constructor.
+
+	Arguments:
+	tracker	--	A libeyelink, libsmi or dummy tracker object.
+
+	Returns:
+	A (velocity threshold, acceleration threshold) tuple in degrees per #
+	second and degrees per second**2. Trackers that don't keep their #
+	thresholds get the constructor defaults (35, 9500).
+	"""
+
+	if hasattr(tracker, u'spdtresh'):
+		return tracker.spdtresh, tracker.accthresh
+	if hasattr(tracker, u'saccade_velocity_treshold'):
+		return tracker.saccade_velocity_treshold, \
+			tracker.saccade_acceleration_treshold
+	return 35, 9500
+
+def _positions(samples):
+
+	"""
+	Gets the gaze positions, with missing data replaced by NaN.
+
+	Arguments:
+	samples	--	A sample array.
+
+	Returns:
+	An (x, y) tuple of float arrays.
+	"""
+
+	x = numpy.where(samples['valid'], samples['x'], numpy.nan)
+	y = numpy.where(samples['valid'], samples['y'], numpy.nan)
+	return x, y
+
+def gaze_velocity(samples, pixperdeg):
+
+	"""
+	Calculates the velocity and acceleration of the gaze. The value for a #
+	sample refers to the movement from the previous sample, in the same way #
+	as for the online detection in eventdetection.event_detector.
+
+	Arguments:
+	samples		--	A sample array.
+	pixperdeg	--	The number of pixels per degree of visual angle.
+
+	Returns:
+	A (velocity, acceleration) tuple of arrays in degrees per second and #
+	degrees per second**2. Values that cannot be determined, because of #
+	missing data or at the start of the array, are NaN.
+	"""
+
+	x, y = _positions(samples)
+	velocity = numpy.empty(len(samples))
+	acceleration = numpy.empty(len(samples))
+	velocity[:1] = numpy.nan
+	acceleration[:2] = numpy.nan
+	if len(samples) < 2:
+		return velocity, acceleration
+	# Intervals in seconds; duplicate timestamps would divide by zero
+	dt = numpy.diff(samples['timestamp']) / 1000.
+	dt[dt <= 0] = numpy.nan
+	velocity[1:] = numpy.hypot(numpy.diff(x), numpy.diff(y)) / pixperdeg / dt
+	acceleration[2:] = numpy.diff(velocity[1:]) / dt[1:]
+	return velocity, acceleration
+
+def segments(mask):
+
+	"""
+	Finds the runs of True values in a boolean array.
+
+	Arguments:
+	mask	--	A boolean array.
+
+	Returns:
+	A (starts, ends) tuple of index arrays, where the ends are exclusive.
+	"""
+
+	edges = numpy.diff(numpy.concatenate(([0], mask.astype(numpy.int8), \
+		[0])))
+	return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)
+
+def event_table(samples, mask, velocity=None, min_duration=0):
+
+	"""
+	Converts a classification into a list of events.
+
+	Arguments:
+	samples			--	A sample array.
+	mask			--	A boolean array that indicates which samples belong #
+						to an event of the type of interest.
+
+	Keyword arguments:
+	velocity		--	The velocity array from gaze_velocity(), or None #
+						to leave the peak velocity at NaN. (default=None)
+	min_duration	--	The minimum duration of an event (ms). Shorter #
+						events are discarded. (default=0)
+
+	Returns:
+	An array in the EVENT_DTYPE layout.
+	"""
+
+	starts, ends = segments(mask)
+	events = numpy.zeros(len(starts), dtype=EVENT_DTYPE)
+	if len(starts) == 0:
+		return events
+	last = ends - 1
+	t = samples['timestamp']
+	events['startindex'] = starts
+	events['endindex'] = ends
+	events['start'] = t[starts]
+	events['end'] = t[last]
+	events['duration'] = t[last] - t[starts]
+	events['startx'] = samples['x'][starts]
+	events['starty'] = samples['y'][starts]
+	events['endx'] = samples['x'][last]
+	events['endy'] = samples['y'][last]
+	# Means over the valid samples of each event, with cumulative sums so
+	# that there is no loop over the events
+	x, y = _positions(samples)
+	valid = ~numpy.isnan(x)
+	n = numpy.concatenate(([0], numpy.cumsum(valid)))
+	sx = numpy.concatenate(([0], numpy.cumsum(numpy.where(valid, x, 0))))
+	sy = numpy.concatenate(([0], numpy.cumsum(numpy.where(valid, y, 0))))
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		count = (n[ends] - n[starts]).astype(numpy.float64)
+		events['meanx'] = (sx[ends] - sx[starts]) / count
+		events['meany'] = (sy[ends] - sy[starts]) / count
+	if velocity is None:
+		events['peakvelocity'] = numpy.nan
+	else:
+		# Reducing over interleaved (start, end) pairs gives the maximum
+		# over each event at even positions; the padding keeps an end at the
+		# end of the array a valid index
+		v = numpy.where(numpy.isnan(velocity), -numpy.inf, velocity)
+		v = numpy.concatenate((v, [-numpy.inf]))
+		bounds = numpy.column_stack((starts, ends)).ravel()
+		peak = numpy.maximum.reduceat(v, bounds)[::2]
+		peak[numpy.isinf(peak)] = numpy.nan
+		events['peakvelocity'] = peak
+	return events[events['duration'] >= min_duration]
+
+def ivt(samples, pixperdeg, velocity_threshold=35, \
+	acceleration_threshold=9500, min_fixation_duration=0):
+
+	"""
+	Classifies samples with a velocity threshold (I-VT). A sample is #
+	saccadic if its velocity or acceleration exceeds the threshold, which is #
+	the same criterion as for the online saccade detection. Other valid #
+	samples are fixation samples.
+
+	Arguments:
+	samples					--	A sample array.
+	pixperdeg				--	The number of pixels per degree of visual #
+								angle.
+
+	Keyword arguments:
+	velocity_threshold		--	The saccade velocity threshold in degrees #
+								per second. (default=35)
+	acceleration_threshold	--	The saccade acceleration threshold in #
+								degrees per second**2. (default=9500)
+	min_fixation_duration	--	The minimum duration of a fixation (ms). #
+								(default=0)
+
+	Returns:
+	A (fixations, saccades) tuple of arrays in the EVENT_DTYPE layout.
+	"""
+
+	velocity, acceleration = gaze_velocity(samples, pixperdeg)
+	with numpy.errstate(invalid='ignore'):
+		saccadic = (velocity > velocity_threshold) | \
+			(acceleration > acceleration_threshold)
+	fixating = samples['valid'] & ~saccadic
+	return event_table(samples, fixating, velocity, \
+		min_duration=min_fixation_duration), \
+		event_table(samples, saccadic, velocity)
+
+def _rolling_range(a, n):
+
+	"""
+	Calculates the range (maximum minus minimum) of every window of n #
+	consecutive values, without copying the windows.
+
+	Arguments:
+	a	--	A float array.
+	n	--	The window length.
+
+	Returns:
+	An array of len(a) - n + 1 ranges.
+	"""
+
+	windows = as_strided(a, shape=(len(a) - n + 1, n), \
+		strides=(a.strides[0], a.strides[0]))
+	return windows.max(axis=1) - windows.min(axis=1)
+
+def idt(samples, pixperdeg, dispersion_threshold=1.5, min_duration=100, \
+	velocity_threshold=35):
+
+	"""
+	Classifies samples with a dispersion threshold (I-DT). A sample is a #
+	fixation sample if it is part of a window of min_duration whose #
+	dispersion (horizontal plus vertical range) doesn't exceed the #
+	threshold. Unlike the sequential I-DT algorithm, all windows are tested #
+	at once, and the union of the windows that pass is taken. Valid samples #
+	outside fixations that exceed the velocity threshold are saccadic.
+
+	Arguments:
+	samples					--	A sample array.
+	pixperdeg				--	The number of pixels per degree of visual #
+								angle.
+
+	Keyword arguments:
+	dispersion_threshold	--	The maximum dispersion of a fixation in #
+								degrees. (default=1.5)
+	min_duration			--	The minimum duration of a fixation (ms). #
+								(default=100)
+	velocity_threshold		--	The saccade velocity threshold in degrees #
+								per second. (default=35)
+
+	Returns:
+	A (fixations, saccades) tuple of arrays in the EVENT_DTYPE layout.
+	"""
+
+	velocity = gaze_velocity(samples, pixperdeg)[0]
+	fixating = numpy.zeros(len(samples), dtype=bool)
+	if len(samples) > 1:
+		# The window length in samples follows from the median interval
+		interval = numpy.median(numpy.diff(samples['timestamp']))
+		n = max(int(round(min_duration / interval)) + 1, 2) if interval > 0 \
+			else 2
+		if n <= len(samples):
+			x, y = _positions(samples)
+			# Windows with missing data have a NaN dispersion, and fail
+			with numpy.errstate(invalid='ignore'):
+				ok = (_rolling_range(x, n) + _rolling_range(y, n)) / \
+					pixperdeg <= dispersion_threshold
+			# Mark every sample that is covered by at least one window
+			cover = numpy.zeros(len(samples) + 1, dtype=numpy.int64)
+			cover[:len(ok)] += ok
+			cover[n:n + len(ok)] -= ok
+			fixating = numpy.cumsum(cover[:-1]) > 0
+	with numpy.errstate(invalid='ignore'):
+		saccadic = samples['valid'] & ~fixating & \
+			(velocity > velocity_threshold)
+	return event_table(samples, fixating, velocity), \
+		event_table(samples, saccadic, velocity)
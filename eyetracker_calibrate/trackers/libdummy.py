@@ -15,6 +15,11 @@ You should have received a copy of the GNU General Public License
 along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import numpy
+from samplebuffer import SAMPLE_DTYPE
+from pollscheduler import to_deadline, stop_waiting
+from timeit import default_timer
+
 class libdummy:
 
 	"""
@@ -22,8 +27,9 @@ class libdummy:
 	no tracker attached.
 	"""
 
-	def __init__(self, experiment, resolution, data_file=u'default.edf', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False):
+	def __init__(self, experiment, resolution, data_file=u'default.edf', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False, buffered=False, lossless=False, velocity_filter=False):
 		self.experiment = experiment
+		self.pollstate = None
 	
 	def send_command(self, cmd):
 		pass
@@ -58,7 +64,7 @@ class libdummy:
 		return True
 	
 	def start_recording(self):
-		pass
+		self.pollstate = None
 		
 	def stop_recording(self):
 		pass
@@ -72,37 +78,96 @@ class libdummy:
 	def sample(self):
 		pass
 	
+	def sample_full(self):
+		pass
+
+	def wait_for_new_sample(self, timeout=None):
+		pass
+
 	def pupil_size(self):
 		pass
 
-	def wait_for_event(self, event):
+	def get_samples(self, since=None, n=None):
+		return numpy.zeros(0, dtype=SAMPLE_DTYPE)
+
+	def wait_for_event(self, event, timeout=None, abort_check=None):
+		outcome = self.wait_for_any([event], timeout=timeout, abort_check=abort_check)
+		if outcome == None:
+			return None
+		return outcome[1]
+
+	def wait_for_any(self, events, timeout=None, abort_check=None):
+		# like the other dummy waits, the first event occurs after 100 ms,
+		# unless the timeout expires or abort_check returns True first; a
+		# blocking wait ends the ongoing incremental wait
+		self.pollstate = None
+		events = list(events)
+		deadline = to_deadline(timeout)
+		occurs = to_deadline(100)
+		while default_timer() < occurs:
+			if stop_waiting(deadline, abort_check):
+				return None
+			self.experiment.sleep(1)
+		return events[0], (self.experiment.time(), ())
+
+	def poll_event(self, event, restart=False):
+		outcome = self.poll_any([event], restart=restart)
+		if outcome == None:
+			return None
+		return outcome[1]
+
+	def poll_any(self, events, restart=False):
+		# a new wait starts on the first call, on the first call after the
+		# event was returned, start_recording or a wait, and on restart
+		events = list(events)
+		if restart or self.pollstate == None or self.pollstate[0] != frozenset(events):
+			self.pollstate = frozenset(events), to_deadline(100)
+		if default_timer() < self.pollstate[1]:
+			return None
+		self.pollstate = None
+		return events[0], (self.experiment.time(), ())
+
+	def subscribe(self, event, callback, main_loop=False):
+		return 0
+
+	def unsubscribe(self, subscription):
 		pass
+
+	def dispatch_events(self):
+		return 0
 		
 	def wait_for_saccade_start(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)
 
 	def __wait_for_saccade_start_pre_10028(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)
 
 	def wait_for_saccade_end(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0), (0, 0)
 
 	def wait_for_fixation_start(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)	
 		
 	def wait_for_fixation_end(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)	
 	
 	def wait_for_blink_start(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)	
 	
 	def wait_for_blink_end(self):
+		self.pollstate = None
 		self.experiment.sleep(100)
 		return self.experiment.time(), (0, 0)
 
@@ -19,13 +19,18 @@ from openexp.keyboard import keyboard
 from openexp.mouse import mouse
 from openexp.canvas import canvas
 from openexp.synth import synth
+from samplebuffer import sample_buffer, sample_record
+from pollscheduler import poll_scheduler, to_deadline, time_left, stop_waiting
+from eventbus import event_bus
+from eventdetection import event_detector, blink_detector, STARTBLINK, ENDBLINK, STARTSACC, ENDSACC, STARTFIX, ENDFIX
+from timeit import default_timer
 
 
 class libdummytracker:
 
 	"""A dummy class to keep things running if there is no tracker attached."""
 
-	def __init__(self, experiment, resolution, data_file="default.edf", fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=u'yes'):
+	def __init__(self, experiment, resolution, data_file="default.edf", fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=u'yes', buffered=False, lossless=False, velocity_filter=False):
 
 		"""Initializes the eyelink dummy object"""
 
@@ -39,6 +44,15 @@ class libdummytracker:
 
 		self.blinking = False # current 'blinking' condition (MOUSEBUTTONDOWN = eyes closed; MOUSEBUTTONUP = eyes open)
 		self.bbpos = (resolution[0]/2,resolution[1]/2) # before 'blink' position
+		self.sample_buffer = sample_buffer() # every simulated sample is buffered, with experiment time as tracker time
+		self.sampletime = 10 # ms between simulated samples during waits (runs go faster than mouse moves)
+		self.scheduler = poll_scheduler(self.sampletime) # paces wait_for_new_sample to the simulated sample rate
+		self.detector = event_detector(3, float('inf'), 3, fixduration=40) # 3 pixels per sample (velocity) and 3 pixels over 40 ms, i.e. five samples (dispersion); no acceleration criterion
+		self.blinkdetector = blink_detector(min_duration=0, max_duration=float('inf')) # every simulated blink counts
+		self.bus = event_bus() # callbacks that have subscribed to simulated events, see subscribe()
+		self.monitordetectors = [event_detector(3, float('inf'), 3, fixduration=40), blink_detector(min_duration=0, max_duration=float('inf'))] # separate detectors for subscribed events, so that they don't interfere with the wait_for_* functions
+		self.monitortime = None # default_timer time of the previous sample that was taken by dispatch_events()
+		self.pollstate = None # the events and detectors of the ongoing incremental wait, see poll_event()
 
 		# check if blinking functionality is possible
 		if not hasattr(self.simulator, 'get_pressed') or not hasattr(self.simulator, 'set_poesje'):
@@ -181,6 +195,11 @@ class libdummytracker:
 		"""Start dummy recording"""
 
 		self.simulator.set_visible(visible=True)
+		self.scheduler.start()
+		self.pollstate = None # an incremental wait doesn't continue into a new recording
+		for detector in self.monitordetectors:
+			detector.reset()
+		self.monitortime = None
 		self.recording = True
 		print 'libeyelink.start_recording(): recording started'
 
@@ -189,6 +208,7 @@ class libdummytracker:
 		"""Stop dummy recording"""
 
 		self.simulator.set_visible(visible=False)
+		self.scheduler.stop()
 		self.recording = False
 		print 'libeyelink.stop_recording(): recording stopped'
 
@@ -222,7 +242,69 @@ class libdummytracker:
 					self.bbpos =  self.simulator.get_pos()[0] # position before blinking
 					self.simulator.set_pos(pos=(self.bbpos[0],self.resolution[1])) # set position to blinking position
 
-		return self.simulator.get_pos()[0]
+		pos = self.simulator.get_pos()[0]
+		self.sample_buffer.push(self.experiment.time(), pos[0], pos[1], 0, 0, not self.blinking)
+		return pos
+
+	def sample_full(self):
+
+		"""Returns a sample_record of the simulated gaze position (=mouse position)"""
+
+		self.sample()
+		return sample_record(*self.sample_buffer.newest())
+
+	def wait_for_new_sample(self, timeout=None):
+
+		"""Waits for a new simulated sample; a new sample is available every self.sampletime ms. Returns a sample_record, or None if timeout (ms) expired first"""
+
+		deadline = to_deadline(timeout)
+		while self.scheduler.last != None and default_timer() < self.scheduler.last + self.scheduler.interval:
+			if deadline != None and default_timer() >= deadline:
+				return None
+			self.scheduler.pause(deadline)
+		self.scheduler.arrived()
+		return self.sample_full()
+
+	def _wait_for_detected_event(self, events, timeout=None, abort_check=None):
+
+		"""Feeds new simulated samples to the event and blink detectors until one of them detects an event of any of the specified types, and returns the eventdetection.gaze_event, or None if the timeout (ms) expired or abort_check returned True first"""
+
+		self.pollstate = None # a blocking wait ends the ongoing incremental wait
+		events = frozenset(events)
+		detectors = self._start_detection(events)
+		deadline = to_deadline(timeout)
+		while True:
+			if stop_waiting(deadline, abort_check):
+				return None
+			s = self.wait_for_new_sample(timeout=time_left(deadline))
+			if s == None:
+				continue
+			e = self._detect(detectors, events, s)
+			if e != None:
+				return e
+
+	def _start_detection(self, events):
+
+		"""Resets, and returns a list of, the detectors for a frozenset of event codes"""
+
+		detectors = []
+		if events & frozenset((STARTBLINK, ENDBLINK)):
+			detectors.append(self.blinkdetector)
+		if events - frozenset((STARTBLINK, ENDBLINK)):
+			detectors.append(self.detector)
+		for detector in detectors:
+			detector.reset()
+		return detectors
+
+	def _detect(self, detectors, events, s):
+
+		"""Feeds a simulated sample to the detectors, and returns the first eventdetection.gaze_event of any of the specified types, or None"""
+
+		for detector in detectors:
+			for e in detector.update(s.timestamp, s.x, s.y, s.valid):
+				if e.type in events:
+					return e
+		return None
 
 	def pupil_size(self):
 
@@ -230,40 +312,111 @@ class libdummytracker:
 
 		return 0
 
-	def wait_for_event(self, event):
+	def get_samples(self, since=None, n=None):
+
+		"""Returns a structured numpy array of the most recent simulated samples"""
+
+		return self.sample_buffer.window(since=since, n=n)
+
+	def wait_for_event(self, event, timeout=None, abort_check=None):
+
+		"""Waits for simulated event (3=STARTBLINK, 4=ENDBLINK, 5=STARTSACC, 6=ENDSACC, 7=STARTFIX, 8=ENDFIX); returns None if the timeout (ms) expired or abort_check returned True first"""
+
+		outcome = self.wait_for_any([event], timeout=timeout, abort_check=abort_check)
+		if outcome == None:
+			return None
+
+		return outcome[1]
+
+	def poll_event(self, event, restart=False):
+
+		"""Checks whether a simulated event has occurred, without waiting; the incremental form of wait_for_event, for calling once per display frame. The first call for an event, the first call after the event was returned, the first call after start_recording or a wait_for_* function, and a call with restart=True, start a new wait. Returns the outcome of wait_for_event, or None if the event hasn't occurred (yet)"""
+
+		outcome = self.poll_any([event], restart=restart)
+		if outcome == None:
+			return None
+
+		return outcome[1]
+
+	def poll_any(self, events, restart=False):
+
+		"""Checks whether any of a number of simulated events has occurred, without waiting; the incremental form of wait_for_any (see poll_event). Returns an (event, (time, ())) tuple, or None if none of the events has occurred (yet)"""
 
-		"""Waits for simulated event (3=STARTBLINK, 4=ENDBLINK, 5=STARTSACC, 6=ENDSACC, 7=STARTFIX, 8=ENDFIX)"""
+		if not self.blinkfun:
+			# blinks can't be simulated, so they are not waited for
+			blinks = [event for event in events if event in (STARTBLINK, ENDBLINK)]
+			if len(blinks) > 0:
+				events = [event for event in events if event not in blinks]
+				if len(events) == 0:
+					return blinks[0], (self.experiment.time(), ())
+		events = frozenset(events)
+		if restart or self.pollstate == None or self.pollstate[0] != events:
+			self.pollstate = events, self._start_detection(events)
+		s = self.wait_for_new_sample(timeout=0)
+		if s == None:
+			return None
+		e = self._detect(self.pollstate[1], events, s)
+		if e == None:
+			return None
+		self.pollstate = None
+		return e.type, (self.experiment.time(), ())
 
-		if event == 5:
-			self.wait_for_saccade_start()
-		elif event == 6:
-			self.wait_for_saccade_end()
-		elif event == 7:
-			self.wait_for_fixation_start()
-		elif event == 8:
-			self.wait_for_fixation_end()
-		elif event == 3:
-			self.wait_for_blink_start()
-		elif event == 4:
-			self.wait_for_blink_end()
+	def wait_for_any(self, events, timeout=None, abort_check=None):
 
-		return (self.experiment.time(), ())
+		"""Waits for the first of a number of simulated events, which are all detected from the same samples; returns an (event, (time, ())) tuple, or None if the timeout (ms) expired or abort_check returned True first"""
+
+		if not self.blinkfun:
+			# blinks can't be simulated, so they are not waited for
+			blinks = [event for event in events if event in (STARTBLINK, ENDBLINK)]
+			if len(blinks) > 0:
+				print("libeyelink_dummy: blink functionality not available")
+				events = [event for event in events if event not in blinks]
+				if len(events) == 0:
+					return blinks[0], (self.experiment.time(), ())
+		e = self._wait_for_detected_event(events, timeout=timeout, abort_check=abort_check)
+		if e == None:
+			return None
+
+		return e.type, (self.experiment.time(), ())
+
+	def subscribe(self, event, callback, main_loop=False):
+
+		"""Subscribes a callback to a simulated event and returns a subscription id; as the simulator (the mouse) can only be read from the main loop, events are detected, and all callbacks are called, by dispatch_events(), regardless of main_loop"""
+
+		return self.bus.subscribe(event, callback, main_loop=True)
+
+	def unsubscribe(self, subscription):
+
+		"""Removes a subscription that was made with subscribe()"""
+
+		self.bus.unsubscribe(subscription)
+
+	def dispatch_events(self):
+
+		"""Takes a simulated sample if one is due, detects the subscribed events in it, and calls the callbacks that subscribed to them; returns the number of callbacks that were called"""
+
+		events = self.bus.events()
+		if not self.blinkfun:
+			events = events - frozenset((STARTBLINK, ENDBLINK))
+		if self.recording and len(events) > 0 and (self.monitortime == None or default_timer() >= self.monitortime + self.sampletime / 1000.0):
+			self.monitortime = default_timer()
+			s = self.sample_full()
+			for detector in self.monitordetectors:
+				for e in detector.update(s.timestamp, s.x, s.y, s.valid):
+					if e.type in events:
+						self.bus.publish(e.type, (self.experiment.time(), ()))
+
+		return self.bus.dispatch()
 
 	def wait_for_saccade_start(self):
 
 		"""Returns starting time and starting position when a simulated saccade is started"""
 
-		# function assumes that a 'saccade' has been started when a deviation of more than
-		# maxerr from the initial 'gaze' position has been detected (using Pythagoras, ofcourse)
+		# see eventdetection.event_detector; a 'saccade' starts when the 'gaze' moves faster than self.detector.spdtresh
 
-		spos = self.sample() # starting position
-		maxerr = 3 # pixels
-		while True:
-			npos = self.sample() # get newest sample
-			if ((spos[0]-npos[0])**2  + (spos[1]-npos[1])**2)**0.5 > maxerr: # Pythagoras
-				break
+		e = self._wait_for_detected_event([STARTSACC])
 
-		return self.experiment.time(), spos
+		return self.experiment.time(), e.startpos
 
 	def __wait_for_saccade_start_pre_10028(self):
 
@@ -279,79 +432,31 @@ class libdummytracker:
 
 		"""Returns ending time, starting and end position when a simulated saccade is ended"""
 
-		# function assumes that a 'saccade' has ended when 'gaze' position remains reasonably
-		# (i.e.: within maxerr) stable for five samples
-		# for saccade start algorithm, see wait_for_fixation_start
+		# a 'saccade' ends when the 'gaze' slows down below self.detector.spdtresh
 
-		stime, spos = self.wait_for_saccade_start()
-		maxerr = 3 # pixels
-		
-		# wait for reasonably stable position
-		xl = [] # list for last five samples (x coordinate)
-		yl = [] # list for last five samples (y coordinate)
-		moving = True
-		while moving:
-			# check positions
-			npos = self.sample()
-			xl.append(npos[0]) # add newest sample
-			yl.append(npos[1]) # add newest sample
-			if len(xl) == 5:
-				# check if deviation is small enough
-				if max(xl)-min(xl) < maxerr and max(yl)-min(yl) < maxerr:
-                                        print xl
-                                        print yl
-					moving = False
-				# remove oldest sample
-				xl.pop(0); yl.pop(0)
-			# wait for a bit, to avoid immediately returning (runs go faster than mouse moves)
-			self.experiment.sleep(10)
-
-		return self.experiment.time(), spos, (xl[len(xl)-1],yl[len(yl)-1])
+		e = self._wait_for_detected_event([ENDSACC])
+
+		return self.experiment.time(), e.startpos, e.endpos
 
 	def wait_for_fixation_start(self):
 
 		"""Returns starting time and position when a simulated fixation is started"""
 
-		# function assumes a 'fixation' has started when 'gaze' position remains reasonably
-		# stable for five samples in a row (same as saccade end)
+		# a 'fixation' starts when 'gaze' position remains within self.detector.fixtresh for self.detector.fixduration ms
 
-		maxerr = 3 # pixels
-		
-		# wait for reasonably stable position
-		xl = [] # list for last five samples (x coordinate)
-		yl = [] # list for last five samples (y coordinate)
-		moving = True
-		while moving:
-			npos = self.sample()
-			xl.append(npos[0]) # add newest sample
-			yl.append(npos[1]) # add newest sample
-			if len(xl) == 5:
-				# check if deviation is small enough
-				if max(xl)-min(xl) < maxerr and max(yl)-min(yl) < maxerr:
-					moving = False
-				# remove oldest sample
-				xl.pop(0); yl.pop(0)
-			# wait for a bit, to avoid immediately returning (runs go faster than mouse moves)
-			self.experiment.sleep(10)
-
-		return self.experiment.time(), (xl[len(xl)-1],yl[len(yl)-1])
+		e = self._wait_for_detected_event([STARTFIX])
+
+		return self.experiment.time(), e.startpos
 
 	def wait_for_fixation_end(self):
 
-		"""Returns starting time and position when a simulated fixation is started"""
+		"""Returns starting time and position when a simulated fixation is ended"""
 
-		# function assumes that a 'fixation' has ended when a deviation of more than maxerr
-		# from the initial 'fixation' position has been detected (using Pythagoras, ofcourse)
+		# a 'fixation' ends when 'gaze' deviates more than self.detector.fixtresh from the initial 'fixation' position
 
-		stime, spos = self.wait_for_fixation_start()
-		maxerr = 3 # pixels
-		
-		while True:
-			npos = self.sample() # get newest sample
-			if ((spos[0]-npos[0])**2  + (spos[1]-npos[1])**2)**0.5 > maxerr: # Pythagoras
-				break
+		e = self._wait_for_detected_event([ENDFIX])
 
-		return self.experiment.time(), spos
+		return self.experiment.time(), e.startpos
 
 	def wait_for_blink_start(self):
 
@@ -361,10 +466,9 @@ class libdummytracker:
 		# of the eyes, a mousebuttonup the opening.
 
 		if self.blinkfun:
-			while not self.blinking:
-				pos = self.sample()
+			e = self._wait_for_detected_event([STARTBLINK])
 
-			return self.experiment.time(), pos
+			return self.experiment.time(), e.startpos
 
 		else:
 			print("libeyelink_dummy: blink functionality not available")
@@ -378,14 +482,9 @@ class libdummytracker:
 		# of the eyes, a mousebuttonup the opening.
 
 		if self.blinkfun:
-			# wait for blink start
-			while not self.blinking:
-				spos = self.sample()
-			# wait for blink end
-			while self.blinking:
-				epos = self.sample()
-
-			return self.experiment.time(), epos
+			e = self._wait_for_detected_event([ENDBLINK])
+
+			return self.experiment.time(), e.endpos
 
 		else:
 			print("libeyelink_dummy: blink functionality not available")
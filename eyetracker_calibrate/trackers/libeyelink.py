@@ -30,23 +30,79 @@ from openexp.canvas import canvas
 from openexp.synth import synth
 from openexp.exceptions import response_error
 from libopensesame import exceptions
+from clocksync import clock_model, clock_sync_thread, synchronize
+from eventbus import event_bus
+from eventstore import event_store
+from pollscheduler import poll_scheduler, to_deadline, stop_waiting
+from samplebuffer import sample_buffer, sample_store, sample_record, \
+	acquisition_thread, drain_thread
 import os.path
-import array
 import math
+import numpy
 import tempfile
-try:
-	import Image
-except:
-	from PIL import Image
+import threading
+import collections
+from timeit import default_timer
 
 _eyelink = None
 
+# pylink is not documented to be thread-safe, while the link is used by the
+# main thread, the sample acquisition thread and the clock synchronization
+# thread. Every call to the link therefore holds this lock. It is reentrant, so
+# that a sequence of calls that belong together can hold it as well.
+_link_lock = threading.RLock()
+_locked_link = None
+
+class locked_link(object):
+
+	"""
+	Wraps the EyeLink connection, so that every method call holds the link
+	lock.
+	"""
+
+	def __init__(self, link):
+
+		"""
+		Constructor.
+
+		Arguments:
+		link	--	The pylink.EyeLink object.
+		"""
+
+		self.link = link
+
+	def __getattr__(self, name):
+
+		attr = getattr(self.link, name)
+		if not callable(attr):
+			return attr
+
+		def call(*args, **kwargs):
+			with _link_lock:
+				return attr(*args, **kwargs)
+
+		return call
+
+def _link():
+
+	"""
+	Returns:
+	The EyeLink connection as a locked_link.
+	"""
+
+	global _locked_link
+
+	el = pylink.getEYELINK()
+	if _locked_link == None or _locked_link.link is not el:
+		_locked_link = locked_link(el)
+	return _locked_link
+
 class libeyelink:
 
 	MAX_TRY = 100
 
 
-	def __init__(self, experiment, resolution, data_file=u'default', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False, ip='127.0.0.1', sendport=4444, receiveport=5555, screen_w=399, screen_h=299):
+	def __init__(self, experiment, resolution, data_file=u'default', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False, ip='127.0.0.1', sendport=4444, receiveport=5555, screen_w=399, screen_h=299, buffered=False, lossless=False, velocity_filter=False):
 		"""<DOC>
 		Constructor. Initializes the connection to the Eyelink.
 
@@ -76,6 +132,20 @@ class libeyelink:
 		receiveport		--	ignored by EyeLink
 		screen_w		--	ignored by EyeLink
 		screen_h		--	ignored by EyeLink
+		buffered		--	Indicates whether samples should be acquired by a #
+							background thread and read from a ring buffer, #
+							rather than requested from the link on every #
+							call to sample(). The thread polls the newest #
+							sample, so samples can be missed; their number #
+							is written to the data file as the #
+							dropped_samples variable when recording stops. #
+							(default=False)
+		lossless		--	Indicates whether a background thread should #
+							drain the link queue during recording, so that #
+							every sample is kept (and available through #
+							get_samples()) rather than only the newest one. #
+							This implies buffered sampling. (default=False)
+		velocity_filter	--	ignored by EyeLink
 
 		Returns:
 		True on connection success and False on connection failure.
@@ -101,6 +171,40 @@ class libeyelink:
 		self.left_eye = 0
 		self.right_eye = 1
 		self.binocular = 2
+		self.lossless = lossless
+		self.buffered = buffered or lossless
+		# In lossless mode, samples are kept in a growing store and events are
+		# queued for wait_for_event(), because the background thread consumes
+		# all link data
+		if self.lossless:
+			self.sample_buffer = sample_store()
+		else:
+			self.sample_buffer = sample_buffer()
+		self.link_events = collections.deque()
+		self.acquisition = None
+		# The interval between samples in ms (assuming 1000 Hz until the sample
+		# rate has been read from the tracker) and the timestamp of the sample
+		# that was returned by the previous call to wait_for_new_sample(). The
+		# scheduler decides how long to wait between two polls of the link.
+		self.sampletime = 1.0
+		self.lastsampletime = None
+		# Indicates whether the sample rate has been read, which takes a link
+		# round-trip, so it is only done when recording starts for the first
+		# time, and again after a sample_rate command
+		self.samplerate_read = False
+		self.scheduler = poll_scheduler(self.sampletime)
+		# A model of the offset between the tracker clock and the experiment
+		# clock, which is kept up to date in the background while recording,
+		# so that sample timestamps can be converted without a link round-trip
+		self.clock = clock_model()
+		self.clocksync = None
+		# Callbacks that have subscribed to events, see subscribe()
+		self.bus = event_bus()
+		# The history of fixation, saccade and blink events, see get_events()
+		self.event_store = event_store()
+		# The events and start time of the ongoing incremental wait, see
+		# poll_event()
+		self.pollstate = None
 		
 		# Only initialize the eyelink once
 		if _eyelink == None:
@@ -118,9 +222,9 @@ class libeyelink:
 		if force_drift_correct:
 			self.send_command('driftcorrect_cr_disable = OFF')	
 
-		pylink.getEYELINK().openDataFile(self.data_file)
+		_link().openDataFile(self.data_file)
 		pylink.flushGetkeyQueue()
-		pylink.getEYELINK().setOfflineMode()
+		_link().setOfflineMode()
 
 		# Notify the eyelink of the display resolution
 		self.send_command('screen_pixel_coords =  0 0 %d %d' % ( \
@@ -128,9 +232,9 @@ class libeyelink:
 
 		# Determine the software version of the tracker
 		self.tracker_software_ver = 0
-		self.eyelink_ver = pylink.getEYELINK().getTrackerVersion()
+		self.eyelink_ver = _link().getTrackerVersion()
 		if self.eyelink_ver == 3:
-			tvstr = pylink.getEYELINK().getTrackerVersionString()
+			tvstr = _link().getTrackerVersionString()
 			vindex = tvstr.find("EYELINK CL")
 			self.tracker_software_ver = int(float(tvstr[(vindex + \
 				len("EYELINK CL")):].strip()))
@@ -211,7 +315,9 @@ class libeyelink:
 		cmd		--	The eyelink command to be executed.
 		</DOC>"""
 
-		pylink.getEYELINK().sendCommand(cmd)
+		_link().sendCommand(cmd)
+		if cmd.strip().startswith('sample_rate'):
+			self.samplerate_read = False
 
 	def log(self, msg):
 
@@ -228,7 +334,7 @@ class libeyelink:
 			msg = msg.encode('ascii','ignore')
 		if type(msg) == str:
 			msg = msg.decode('ascii','ignore')
-		pylink.getEYELINK().sendMessage(msg)
+		_link().sendMessage(msg)
 
 	def log_var(self, var, val):
 
@@ -241,7 +347,7 @@ class libeyelink:
 		val		-- The value.
 		</DOC>"""
 
-		pylink.getEYELINK().sendMessage("var %s %s" % (var, val))
+		_link().sendMessage("var %s %s" % (var, val))
 
 	def status_msg(self, msg):
 
@@ -253,7 +359,7 @@ class libeyelink:
 		msg		--	The status message.
 		</DOC>"""
 
-		pylink.getEYELINK().sendCommand("record_status_message '%s'" % msg)
+		_link().sendCommand("record_status_message '%s'" % msg)
 
 	def connected(self):
 
@@ -264,7 +370,7 @@ class libeyelink:
 		True if connected, False otherwise.
 		</DOC>"""
 
-		return pylink.getEYELINK().isConnected()
+		return _link().isConnected()
 
 	def calibrate(self, beep=True, target_size=16):
 
@@ -289,7 +395,7 @@ class libeyelink:
 
 		# attempt calibrate; confirm abort when esc pressed
 		while True:
-			pylink.getEYELINK().doTrackerSetup()
+			_link().doTrackerSetup()
 			if not self.experiment.eyelink_esc_pressed: 
 				break
 			else:
@@ -301,15 +407,83 @@ class libeyelink:
 
 		"""<DOC>
 		Retrieve difference between tracker time (as found in tracker #
-		timestamps) and experiment time.
+		timestamps) and experiment time. While recording, this is taken from #
+		the clock model, which is resynchronized by start_recording() and #
+		kept up to date in the background, so that no link round-trip is #
+		needed. Otherwise, the tracker time is requested.
 
 		Returns:
 		The tracker time minus experiment time.
 		</DOC>"""
 
-		return pylink.getEYELINK().trackerTime() \
+		if self.recording and self.clock.ready():
+			return self.clock.offset(self.clock.tracker_time( \
+				self.experiment.time()))
+		return _link().trackerTime() \
 					- self.experiment.time()
 
+	def get_clock_uncertainty(self):
+
+		"""<DOC>
+		Retrieve the estimated error of the clock offset that is used to #
+		convert tracker timestamps to experiment time.
+
+		Returns:
+		The uncertainty in ms, or None if the clock model has not been #
+		synchronized, which happens when recording starts.
+		</DOC>"""
+
+		if not self.clock.ready():
+			return None
+		return self.clock.uncertainty()
+
+	def _read_sample_rate(self):
+
+		"""
+		Reads the sample rate from the tracker, and updates the sample #
+		interval accordingly. If the sample rate cannot be read, the current #
+		sample interval is kept. Once the sample rate has been read, this #
+		returns immediately, until a sample_rate command is sent.
+		"""
+
+		if self.samplerate_read:
+			return
+		el = _link()
+		el.readRequest('sample_rate')
+		t0 = pylink.currentTime()
+		while pylink.currentTime() - t0 < 500:
+			reply = el.readReply()
+			if reply:
+				try:
+					samplerate = float(reply)
+				except ValueError:
+					break
+				if samplerate > 0:
+					self.sampletime = 1000. / samplerate
+					self.scheduler.set_interval(self.sampletime)
+					self.samplerate_read = True
+				break
+			pylink.msecDelay(1)
+
+	def _measure_clock(self):
+
+		"""
+		Measures the offset between the tracker clock and the experiment clock #
+		once. This is used by the clock synchronization thread.
+
+		Returns:
+		A (tracker time, experiment time, roundtrip) tuple in ms, where the #
+		experiment time is the midpoint of the request.
+		"""
+
+		# The lock is taken before the request is timed, so that waiting for
+		# another thread doesn't count as roundtrip
+		with _link_lock:
+			t0 = self.experiment.time()
+			tracker_time = _link().trackerTime()
+			t1 = self.experiment.time()
+		return tracker_time, (t0 + t1) / 2., t1 - t0
+
 	def drift_correction(self, pos=None, fix_triggered=False):
 
 		"""<DOC>
@@ -360,7 +534,7 @@ class libeyelink:
 		self.send_command("start_drift_correction data = 0 0 1 0")
 		pylink.msecDelay(50)
 		# Wait for a bit until samples start coming in (I think?)
-		if not pylink.getEYELINK().waitForBlockStart(100, 1, 0):
+		if not _link().waitForBlockStart(100, 1, 0):
 			raise exceptions.runtime_error( \
 				u'Failed to perform drift correction (waitForBlockStart error)')
 
@@ -433,12 +607,12 @@ class libeyelink:
 				avg_y = sum(ly) / len(ly)
 				d = math.sqrt( (avg_x - pos[0]) ** 2 + (avg_y - pos[1]) ** 2)
 				# Emulate a spacebar press on success
-				pylink.getEYELINK().sendKeybutton(32, 0, pylink.KB_PRESS)
+				_link().sendKeybutton(32, 0, pylink.KB_PRESS)
 				# getCalibrationResult() returns 0 on success and an exception
 				# or a non-zero value otherwise
 				result = -1
 				try:
-					result = pylink.getEYELINK().getCalibrationResult()
+					result = _link().getCalibrationResult()
 				except:
 					lx = []
 					ly = []
@@ -448,7 +622,7 @@ class libeyelink:
 					ly = []
 					print u'libeyelink.fix_triggered_drift_correction(): try again'
 		# Apply drift correction
-		pylink.getEYELINK().applyDriftCorrect()
+		_link().applyDriftCorrect()
 		self.recording = False
 		print u'libeyelink.fix_triggered_drift_correction(): success'
 		return True
@@ -481,7 +655,7 @@ class libeyelink:
 		# attempt drift correction
 		try:
 			# Params: x, y, draw fix, allow_setup
-			error = pylink.getEYELINK().doDriftCorrect(pos[0], pos[1], 0, 0)
+			error = _link().doDriftCorrect(pos[0], pos[1], 0, 0)
 			if error != 27: # successful DC
 				print u'libeyelink.drift_correction(): success'
 				return True
@@ -508,10 +682,12 @@ class libeyelink:
 		</DOC>"""
 
 		self.recording = True
+		# An incremental wait doesn't continue into a new recording
+		self.pollstate = None
 		i = 0
 		while True:
 			# Params: write  samples, write event, send samples, send events
-			error = pylink.getEYELINK().startRecording(1, 1, 1, 1)
+			error = _link().startRecording(1, 1, 1, 1)
 			if not error:
 				break
 			if i > self.MAX_TRY:
@@ -524,9 +700,30 @@ class libeyelink:
 		# Don't know what this is
 		pylink.pylink.beginRealTimeMode(100)
 		# Wait for a bit until samples start coming in (I think?)
-		if not pylink.getEYELINK().waitForBlockStart(100, 1, 0):
+		if not _link().waitForBlockStart(100, 1, 0):
 			raise exceptions.runtime_error( \
 				u'Failed to start recording (waitForBlockStart error)')
+		self._read_sample_rate()
+		self.scheduler.start()
+		# Resynchronize the clock model, and keep it up to date in the
+		# background, so that timestamps can be converted without a link
+		# round-trip
+		if self.clocksync == None:
+			synchronize(self._measure_clock, self.clock)
+			self.clocksync = clock_sync_thread(self._measure_clock, self.clock)
+			self.clocksync.start()
+		# Optionally start acquiring samples in the background
+		if self.buffered:
+			if self.eye_used == None:
+				self.set_eye_used()
+			self.sample_buffer.clear()
+			if self.lossless:
+				self.link_events.clear()
+				self.acquisition = drain_thread(self._drain_link)
+			else:
+				self.acquisition = acquisition_thread(self._poll_sample, \
+					self.sample_buffer, sampletime=self.sampletime)
+			self.acquisition.start()
 
 	def stop_recording(self):
 
@@ -534,9 +731,18 @@ class libeyelink:
 		Stops recording of gaze samples.
 		</DOC>"""
 
+		if self.acquisition != None:
+			self.acquisition.stop()
+			if not self.lossless:
+				self.log_var("dropped_samples", self.acquisition.dropped)
+			self.acquisition = None
+		if self.clocksync != None:
+			self.clocksync.stop()
+			self.clocksync = None
+		self.scheduler.stop()
 		self.recording = False
 		pylink.endRealTimeMode()
-		pylink.getEYELINK().setOfflineMode()
+		_link().setOfflineMode()
 		pylink.msecDelay(500)
 
 	def close(self):
@@ -549,13 +755,13 @@ class libeyelink:
 			self.stop_recording()
 		# Close the datafile and transfer it to the experimental pc
 		print u'libeyelink: closing data file'
-		pylink.getEYELINK().closeDataFile()
+		_link().closeDataFile()
 		pylink.msecDelay(100)
 		print u'libeyelink: transferring data file'
-		pylink.getEYELINK().receiveDataFile(self.data_file, self.data_file)
+		_link().receiveDataFile(self.data_file, self.data_file)
 		pylink.msecDelay(100)
 		print u'libeyelink: closing eyelink'
-		pylink.getEYELINK().close()
+		_link().close()
 		pylink.msecDelay(100)
 
 	def set_eye_used(self):
@@ -569,7 +775,7 @@ class libeyelink:
 		Raises an exceptions.runtime_error on failure.
 		<DOC>"""
 
-		self.eye_used = pylink.getEYELINK().eyeAvailable()
+		self.eye_used = _link().eyeAvailable()
 		if self.eye_used == self.right_eye:
 			self.log_var("eye_used", "right")
 		elif self.eye_used == self.left_eye or self.eye_used == self.binocular:
@@ -592,21 +798,255 @@ class libeyelink:
 		Raises an exceptions.runtime_error on failure.
 		</DOC>"""
 
+		s = self.sample_full()
+		return s.x, s.y
+
+	def sample_full(self):
+
+		"""<DOC>
+		Gets the most recent sample, including the pupil size. The gaze #
+		position and pupil size are taken from a single link sample, so they #
+		always belong together.
+
+		Returns:
+		A sample_record with the attributes timestamp (tracker time), x, y, #
+		pupil, eye, valid and exptime (the timestamp in experiment time). #
+		Missing data is indicated by valid=False and x, y and pupil values #
+		of -1.
+
+		Exceptions:
+		Raises an exceptions.runtime_error on failure.
+		</DOC>"""
+
 		if not self.recording:
 			raise exceptions.runtime_error( \
 				u'Please start recording before collecting eyelink data')
-		if self.eye_used == None:
-			self.set_eye_used()
-		s = pylink.getEYELINK().getNewestSample()
+		if self.acquisition != None:
+			s = self.sample_buffer.newest()
+		else:
+			if self.eye_used == None:
+				self.set_eye_used()
+			s = self._poll_sample()
 		if s == None:
-			gaze = -1, -1
+			return sample_record(-1, -1, -1, -1, self.eye_used, False)
+		return sample_record(*s)
+
+	def wait_for_new_sample(self, timeout=None):
+
+		"""<DOC>
+		Waits until a sample is available that is newer than the one that was #
+		returned by the previous call. Until shortly before the next sample #
+		can be expected, waiting sleeps rather than polls the link, so that it #
+		doesn't occupy the CPU.
+
+		Keyword arguments:
+		timeout	--	The maximum waiting time in ms, or None to wait #
+					indefinitely. (default=None)
+
+		Returns:
+		A sample_record, or None if the timeout expired.
+
+		Exceptions:
+		Raises an exceptions.runtime_error on failure.
+		</DOC>"""
+
+		deadline = to_deadline(timeout)
+		while True:
+			s = self.sample_full()
+			now = default_timer()
+			if s.timestamp != self.lastsampletime:
+				self.lastsampletime = s.timestamp
+				self.scheduler.arrived(now)
+				return s
+			if deadline != None and now >= deadline:
+				return None
+			self.scheduler.pause(deadline)
+
+	def _poll_sample(self):
+
+		"""
+		Gets the newest sample from the link. This is used by sample_full() #
+		and by the acquisition thread.
+
+		Returns:
+		A (timestamp, x, y, pupil, eye, valid, exptime) tuple, or None if no #
+		sample is available.
+		"""
+
+		s = _link().getNewestSample()
+		if s == None:
+			return None
+		return self._unpack_sample(s)
+
+	def _unpack_sample(self, s):
+
+		"""
+		Converts a pylink sample for the eye that is used. For binocular #
+		recordings, the left eye is used, or the right eye if the sample has #
+		no data for the left eye.
+
+		Arguments:
+		s		--	A pylink sample.
+
+		Returns:
+		A (timestamp, x, y, pupil, eye, valid, exptime) tuple, where exptime #
+		is the timestamp converted to experiment time with the clock model, #
+		and eye is the eye that the data belongs to.
+		"""
+
+		timestamp = s.getTime()
+		exptime = self.clock.experiment_time(timestamp)
+		if self.eye_used == self.binocular:
+			if s.isLeftSample():
+				eye = self.left_eye
+			elif s.isRightSample():
+				eye = self.right_eye
+			else:
+				return timestamp, -1, -1, -1, self.left_eye, False, exptime
 		elif self.eye_used == self.right_eye and s.isRightSample():
-			gaze = s.getRightEye().getGaze()
+			eye = self.right_eye
 		elif self.eye_used == self.left_eye and s.isLeftSample():
-			gaze = s.getLeftEye().getGaze()
+			eye = self.left_eye
+		else:
+			return timestamp, -1, -1, -1, self.eye_used, False, exptime
+		if eye == self.right_eye:
+			e = s.getRightEye()
 		else:
-			gaze = -1, -1
-		return gaze
+			e = s.getLeftEye()
+		x, y = e.getGaze()
+		return timestamp, x, y, e.getPupilSize(), eye, True, exptime
+
+	def _drain_link(self):
+
+		"""
+		Reads all data that is queued on the link. Samples are added to the #
+		sample store and events are stored, queued for wait_for_event(), and #
+		published to the callbacks that have subscribed to them. This is used #
+		by the background thread in lossless mode.
+
+		Returns:
+		The number of data items that were read.
+		"""
+
+		el = _link()
+		n = 0
+		while True:
+			# The data belongs to the item that getNextData() returned, so
+			# another thread must not read in between
+			with _link_lock:
+				d = el.getNextData()
+				if not d:
+					return n
+				float_data = el.getFloatData()
+			n += 1
+			if d == pylink.SAMPLE_TYPE:
+				self.sample_buffer.push(*self._unpack_sample(float_data))
+				self.scheduler.arrived()
+			else:
+				self._store_link_event(d, float_data)
+				self.link_events.append((d, float_data))
+				if d in self.bus.events():
+					self.bus.publish(d, (self.clock.experiment_time( \
+						float_data.getTime()), float_data))
+
+	def _store_link_event(self, d, float_data):
+
+		"""
+		Adds a fixation, saccade or blink event to the event history. Other #
+		events are ignored.
+
+		Arguments:
+		d			--	The event type.
+		float_data	--	The event in float_data format.
+		"""
+
+		if d not in (pylink.STARTBLINK, pylink.ENDBLINK, pylink.STARTSACC, \
+			pylink.ENDSACC, pylink.STARTFIX, pylink.ENDFIX):
+			return
+		nan = float('nan')
+		f = self._link_event_field
+		t = float_data.getTime()
+		startx, starty = f(float_data, 'getStartGaze', (nan, nan))
+		endx, endy = f(float_data, 'getEndGaze', (nan, nan))
+		meanx, meany = f(float_data, 'getAverageGaze', (nan, nan))
+		self.event_store.push((d, f(float_data, 'getEye', -1), t, \
+			self.clock.experiment_time(t), f(float_data, 'getStartTime', nan), \
+			f(float_data, 'getEndTime', nan), startx, starty, endx, endy, \
+			meanx, meany, f(float_data, 'getAveragePupilSize', nan), \
+			f(float_data, 'getPeakVelocity', nan)))
+
+	def _link_event_field(self, float_data, method, default):
+
+		"""
+		Gets a field of an event, if the event type has that field.
+
+		Arguments:
+		float_data	--	The event in float_data format.
+		method		--	The name of the pylink method that returns the field.
+		default		--	The value for events that don't have the field.
+
+		Returns:
+		The value of the field.
+		"""
+
+		if not hasattr(float_data, method):
+			return default
+		return getattr(float_data, method)()
+
+	def _flush_link_events(self, t_0):
+
+		"""
+		Discards the queued events that occurred before a wait began, so #
+		that the wait doesn't have to read them one at a time. In lossless #
+		mode, these are the oldest events that were queued by the background #
+		thread, which has already added them to the event history. #
+		Otherwise, the whole link queue is discarded in a single call, so #
+		the events in it are lost: they are not added to the event history #
+		(see get_events()), and an event that arrives during the call is #
+		discarded as well.
+
+		Arguments:
+		t_0	--	The experiment time at which the wait began.
+		"""
+
+		if not self.lossless:
+			_link().resetData()
+			return
+		# The queue is in order of time, and the background thread only
+		# appends to it, so the old events are all on the left
+		while len(self.link_events) > 0 and self.clock.experiment_time( \
+			self.link_events[0][1].getTime()) <= t_0:
+			self.link_events.popleft()
+
+	def _read_link_event(self):
+
+		"""
+		Gets the oldest queued event, without waiting. In lossless mode, the #
+		link is drained by the background thread, which queues the events #
+		for us. Otherwise, the samples that precede the event on the link are #
+		skipped, and the event is added to the event history.
+
+		Returns:
+		A (type, float_data) tuple, or None if no event is queued.
+		"""
+
+		if self.lossless:
+			try:
+				return self.link_events.popleft()
+			except IndexError:
+				return None
+		el = _link()
+		while True:
+			with _link_lock:
+				d = el.getNextData()
+				if not d:
+					return None
+				if d == pylink.SAMPLE_TYPE:
+					self.scheduler.arrived()
+					continue
+				float_data = el.getFloatData()
+			self._store_link_event(d, float_data)
+			return d, float_data
 
 	def pupil_size(self):
 
@@ -621,53 +1061,310 @@ class libeyelink:
 		Raises an exceptions.runtime_error on failure.
 		</DOC>"""
 
-		if not self.recording:
+		return self.sample_full().pupil
+
+	def get_samples(self, since=None, n=None):
+
+		"""<DOC>
+		Gets a window of buffered samples. This requires that buffered #
+		sampling is enabled.
+
+		Keyword arguments:
+		since	--	A tracker timestamp (ms). Only samples that are more #
+					recent are returned, or None for no limit. (default=None)
+		n		--	The maximum number of (most recent) samples to return, or #
+					None for no limit. (default=None)
+
+		Returns:
+		A structured numpy array with the fields timestamp, x, y, pupil, eye, #
+		valid and exptime (the timestamp in experiment time), in #
+		chronological order.
+
+		Exceptions:
+		Raises an exceptions.runtime_error if buffered sampling is disabled.
+		</DOC>"""
+
+		if not self.buffered:
 			raise exceptions.runtime_error( \
-				u'Please start recording before collecting eyelink data')
-		if self.eye_used == None:
-			self.set_eye_used()
-		s = pylink.getEYELINK().getNewestSample()
-		if s == None:
-			ps = -1
-		elif self.eye_used == self.right_eye and s.isRightSample():
-			ps = s.getRightEye().getPupilSize()
-		elif self.eye_used == self.left_eye and s.isLeftSample():
-			ps = s.getLeftEye().getPupilSize()
-		else:
-			ps = -1
-		return ps
+				u'get_samples() requires buffered sampling')
+		return self.sample_buffer.window(since=since, n=n)
+
+	def get_events(self, types=None, since=None, until=None):
+
+		"""<DOC>
+		Gets the fixation, saccade and blink events from the event history. #
+		In lossless mode, the history contains every event: the events that #
+		are flushed at the start of a wait are kept, and only since and #
+		until filter them. Otherwise, it contains the events that were read #
+		while waiting for an event, because the link queue is discarded #
+		without being read at the start of a wait.
+
+		Keyword arguments:
+		types	--	A list of EyeLink events, such as [pylink.ENDFIX], or #
+					None for all types. (default=None)
+		since	--	A tracker timestamp (ms). Only events that are more #
+					recent are returned, or None for no limit. (default=None)
+		until	--	A tracker timestamp (ms). Only events that occurred #
+					before are returned, or None for no limit. #
+					(default=None)
+
+		Returns:
+		A structured numpy array in the eventstore.STORED_EVENT_DTYPE #
+		layout, sorted by time. The time is the tracker timestamp of the #
+		event and exptime the same moment in experiment time.
+		</DOC>"""
 
-	def wait_for_event(self, event):
+		return self.event_store.events(types=types, since=since, until=until)
+
+	def get_last_event(self, types=None, before=None):
+
+		"""<DOC>
+		Gets the most recent event from the event history (see get_events()).
+
+		Keyword arguments:
+		types	--	A list of EyeLink events, such as [pylink.ENDSACC], or #
+					None for all types. (default=None)
+		before	--	A tracker timestamp (ms). Only events that occurred #
+					before are considered, or None for no limit. #
+					(default=None)
+
+		Returns:
+		An event in the eventstore.STORED_EVENT_DTYPE layout, or None if #
+		there is no such event.
+		</DOC>"""
+
+		return self.event_store.last(types=types, before=before)
+
+	def wait_for_event(self, event, timeout=None, abort_check=None):
 
 		"""<DOC>
 		Waits until an event has occurred.
 
 		Arguments:
-		event	-- An EyeLink event, such as pylink.STARTSACC.
+		event		--	An EyeLink event, such as pylink.STARTSACC.
+
+		Keyword arguments:
+		timeout		--	The maximum waiting time in ms, or None to wait #
+						indefinitely. (default=None)
+		abort_check	--	A function that is called repeatedly while waiting, #
+						and which returns True to stop waiting, for example #
+						because a response was collected. (default=None)
 
 		Returns:
 		A tuple (timestamp, event). The event is in float_data format. The #
-		timestamp is in experiment time.
+		timestamp is in experiment time. None if the timeout expired or #
+		abort_check returned True before the event occurred.
+
+		Exceptions:
+		Raises an exceptions.runtime_error on failure.
+		</DOC>"""
+
+		outcome = self.wait_for_any([event], timeout=timeout, \
+			abort_check=abort_check)
+		if outcome == None:
+			return None
+		return outcome[1]
+
+	def wait_for_any(self, events, timeout=None, abort_check=None):
+
+		"""<DOC>
+		Waits until any of a number of events has occurred. The link data is #
+		read only once, so that none of the events can be missed while #
+		waiting for another.
+
+		Arguments:
+		events		--	A list of EyeLink events, such as #
+						[pylink.STARTSACC, pylink.STARTBLINK].
+
+		Keyword arguments:
+		timeout		--	The maximum waiting time in ms, or None to wait #
+						indefinitely. (default=None)
+		abort_check	--	A function that is called repeatedly while waiting, #
+						and which returns True to stop waiting, for example #
+						because a response was collected. (default=None)
+
+		Returns:
+		A tuple (event type, (timestamp, event)) for the first event that #
+		occurred, where the second element is as returned by #
+		wait_for_event(). None if the timeout expired or abort_check #
+		returned True before any of the events occurred.
 
 		Exceptions:
 		Raises an exceptions.runtime_error on failure.
 		</DOC>"""
 
+		# A blocking wait ends the ongoing incremental wait, see poll_event()
+		self.pollstate = None
 		if not self.recording:
 			raise exceptions.runtime_error( \
 				u'Please start recording before collecting eyelink data')
 		if self.eye_used == None:
 			self.set_eye_used()
+		events = frozenset(events)
+		deadline = to_deadline(timeout)
 		t_0 = self.experiment.time()
+		self._flush_link_events(t_0)
 		while True:
-			d = 0
-			while d != event:
-				d = pylink.getEYELINK().getNextData()
-			# ignore d if its event occured before t_0:
-			float_data = pylink.getEYELINK().getFloatData()
-			if float_data.getTime() - self.get_eyelink_clock_async() > t_0:
-				break
-		return float_data.getTime() - self.get_eyelink_clock_async(), float_data
+			outcome = self._match_link_event(events, t_0)
+			if outcome != None:
+				return outcome
+			# The queue is empty, so wait until the next sample is due
+			if stop_waiting(deadline, abort_check):
+				return None
+			self.scheduler.pause(deadline)
+
+	def _match_link_event(self, events, t_0):
+
+		"""
+		Reads the queued events, without waiting, until one matches.
+
+		Arguments:
+		events	--	A frozenset of EyeLink events.
+		t_0		--	The experiment time at which the wait began. Events #
+					that occurred earlier are ignored.
+
+		Returns:
+		A tuple (event type, (timestamp, event)) for the first matching #
+		event, or None if the queue was emptied without a match.
+		"""
+
+		while True:
+			queued = self._read_link_event()
+			if queued == None:
+				return None
+			d, float_data = queued
+			if d not in events:
+				continue
+			# ignore d if its event occured before t_0; the timestamp is
+			# converted with the clock model rather than a link round-trip
+			t = self.clock.experiment_time(float_data.getTime())
+			if t > t_0:
+				return d, (t, float_data)
+
+	def poll_event(self, event, restart=False):
+
+		"""<DOC>
+		Checks whether an event has occurred, without waiting. This is the #
+		incremental form of wait_for_event(), which can be called once per #
+		display frame, so that the display keeps being updated while waiting #
+		for an event. The first call for an event, the first call after the #
+		event was returned, and the first call after start_recording() or a #
+		wait_for_* function, starts a new wait (as if wait_for_event() was #
+		called). Every call reads the data that arrived since the previous #
+		call, and then returns immediately.
+
+		Arguments:
+		event	--	An EyeLink event, such as pylink.STARTSACC.
+
+		Keyword arguments:
+		restart	--	Indicates whether a new wait should be started, for #
+					example at the start of a trial, even if the previous #
+					call was for the same event. (default=False)
+
+		Returns:
+		A tuple (timestamp, event) as returned by wait_for_event(), or None #
+		if the event hasn't occurred (yet).
+
+		Exceptions:
+		Raises an exceptions.runtime_error on failure.
+		</DOC>"""
+
+		outcome = self.poll_any([event], restart=restart)
+		if outcome == None:
+			return None
+		return outcome[1]
+
+	def poll_any(self, events, restart=False):
+
+		"""<DOC>
+		Checks whether any of a number of events has occurred, without #
+		waiting. This is the incremental form of wait_for_any() (see #
+		poll_event()).
+
+		Arguments:
+		events	--	A list of EyeLink events.
+
+		Keyword arguments:
+		restart	--	Indicates whether a new wait should be started (see #
+					poll_event()). (default=False)
+
+		Returns:
+		A tuple (event type, (timestamp, event)) as returned by #
+		wait_for_any(), or None if none of the events has occurred (yet).
+
+		Exceptions:
+		Raises an exceptions.runtime_error on failure.
+		</DOC>"""
+
+		if not self.recording:
+			raise exceptions.runtime_error( \
+				u'Please start recording before collecting eyelink data')
+		if self.eye_used == None:
+			self.set_eye_used()
+		events = frozenset(events)
+		if restart or self.pollstate == None or self.pollstate[0] != events:
+			self.pollstate = events, self.experiment.time()
+			self._flush_link_events(self.pollstate[1])
+		outcome = self._match_link_event(events, self.pollstate[1])
+		if outcome != None:
+			self.pollstate = None
+		return outcome
+
+	def subscribe(self, event, callback, main_loop=False):
+
+		"""<DOC>
+		Subscribes a callback to an event, so that the event can be reacted #
+		to without blocking in a wait_for_* function. The events are #
+		published by the background thread that drains the link, which #
+		requires lossless mode.
+
+		Arguments:
+		event		--	An EyeLink event, such as pylink.STARTSACC.
+		callback	--	A function that is called with the event and the #
+						outcome of the event, as returned by #
+						wait_for_event(), as arguments.
+
+		Keyword arguments:
+		main_loop	--	If False, the callback is called from the background #
+						thread, so it shouldn't use the display. If True, #
+						the callback is queued until the main loop calls #
+						dispatch_events(). (default=False)
+
+		Returns:
+		A subscription id, which can be passed to unsubscribe().
+
+		Exceptions:
+		Raises an exceptions.runtime_error if lossless mode is disabled.
+		</DOC>"""
+
+		if not self.lossless:
+			raise exceptions.runtime_error( \
+				u'Subscribing to events requires lossless sampling')
+		return self.bus.subscribe(event, callback, main_loop=main_loop)
+
+	def unsubscribe(self, subscription):
+
+		"""<DOC>
+		Removes a subscription that was made with subscribe().
+
+		Arguments:
+		subscription	--	A subscription id.
+		</DOC>"""
+
+		self.bus.unsubscribe(subscription)
+
+	def dispatch_events(self):
+
+		"""<DOC>
+		Calls the callbacks that subscribed to events with main_loop=True, #
+		for the events that were detected since the previous call. This #
+		should be called regularly from the main loop.
+
+		Returns:
+		The number of callbacks that were called.
+		</DOC>"""
+
+		return self.bus.dispatch()
 
 	def wait_for_saccade_start(self):
 
@@ -881,7 +1578,7 @@ class libeyelink:
 				raise exceptions.runtime_error( \
 					u'Invalid tuple; needs to be (array2d.image,width,height)')
 			else:
-				el = pylink.getEYELINK()
+				el = _link()
 
 				# "Forward" compatibility
 				# In the current unofficial version of pylink, the function that
@@ -939,7 +1636,9 @@ class eyelink_graphics(custom_display):
 
 		self.state = None
 
-		self.imagebuffer = array.array('l')
+		# The camera image, as one packed RGBX pixel per element, which is
+		# reused for every frame
+		self.framebuffer = None
 		self.pal = None
 		self.size = (0,0)
 		self.tmp_file = os.path.join(tempfile.gettempdir(), '__eyelink__.jpg')
@@ -1155,7 +1854,6 @@ class eyelink_graphics(custom_display):
 		self.size = (width,height)
 		self.clear_cal_display()
 		self.last_mouse_state = -1
-		self.imagebuffer = array.array('l')
 
 	def image_title(self, text):
 
@@ -1172,42 +1870,53 @@ class eyelink_graphics(custom_display):
 		width -- the width of the video
 		line -- the line nr of the current line
 		totlines -- the total nr of lines in a video
-		buff -- the frame buffer
+		buff -- the palette indices of the pixels on the line
 		"""
 
-		for i in range(width):
-			try:
-				self.imagebuffer.append(self.pal[buff[i]])
-			except:
-				pass
+		if self.pal is None:
+			return
+		# The frame buffer is only reallocated when the video size changes
+		if self.framebuffer is None or self.framebuffer.shape != \
+			(totlines, width):
+			self.framebuffer = numpy.zeros((totlines, width), dtype='<u4')
+		# Decode the line with a single palette lookup; indices outside the
+		# palette get the last colour
+		indices = numpy.asarray(buff, dtype=numpy.intp)[:width]
+		row = min(max(line, 1), totlines) - 1
+		self.pal.take(indices, out=self.framebuffer[row, :len(indices)], \
+			mode='clip')
 
 		if line == totlines:
-			bufferv = self.imagebuffer.tostring()
-			img = Image.new("RGBX", self.size)
-			img.fromstring(bufferv)
-			img = img.resize(self.size)
-			img = pygame.image.fromstring(img.tostring(), self.size, "RGBX")
+			# The surface is built directly on the frame buffer, and scaled
+			# into a new surface, so the buffer can be reused for the next
+			# frame
+			img = pygame.image.frombuffer(self.framebuffer, (width, \
+				totlines), "RGBX")
 			self.my_canvas.clear()
-			pygame.image.save(img, self.tmp_file)
-			self.my_canvas.image(self.tmp_file, scale=2.)
+			# Only the legacy back-end draws on a pygame surface, so the other
+			# back-ends still get the image through a file
+			if self.experiment.canvas_backend == u'legacy':
+				img = pygame.transform.scale(img, (2 * self.size[0], \
+					2 * self.size[1]))
+				self.my_canvas.surface.blit(img, (self.my_canvas.xcenter() - \
+					self.size[0], self.my_canvas.ycenter() - self.size[1]))
+			else:
+				img = pygame.transform.scale(img, self.size)
+				pygame.image.save(img, self.tmp_file)
+				self.my_canvas.image(self.tmp_file, scale=2.)
 			self.my_canvas.show()
-			self.imagebuffer = array.array('l')
 
 	def set_image_palette(self, r, g, b):
 
 		"""Set the image palette"""
 
-		self.imagebuffer = array.array('l')
 		self.clear_cal_display()
-		sz = len(r)
-		i =0
-		self.pal = []
-		while i < sz:
-			rf = int(b[i])
-			gf = int(g[i])
-			bf = int(r[i])
-			self.pal.append((rf<<16) | (gf<<8) | (bf))
-			i = i+1
+		# Each colour is packed so that its little-endian bytes are R, G, B
+		# and padding, the layout of an RGBX image
+		r = numpy.asarray(r, dtype='<u4')
+		g = numpy.asarray(g, dtype='<u4')
+		b = numpy.asarray(b, dtype='<u4')
+		self.pal = (b << 16) | (g << 8) | r
 
 
 
@@ -42,11 +42,32 @@ from openexp.synth import synth
 from openexp.exceptions import response_error
 from libopensesame import exceptions
 
-import copy
+import ctypes
 import math
+import time
+from timeit import default_timer
+import numpy
+
+from clocksync import clock_model, clock_sync_thread, synchronize
+from eventbus import event_bus, detection_thread
+from eventdetection import gaze_event, event_detector, blink_detector, \
+	precision_estimator, \
+	savitzky_golay_coefficients, sg_differentiator, STARTBLINK, ENDBLINK, \
+	STARTSACC, ENDSACC, STARTFIX, ENDFIX
+from pollscheduler import poll_scheduler, to_deadline, time_left, \
+	stop_waiting
+from samplebuffer import SAMPLE_DTYPE, sample_buffer, sample_record, \
+	struct_ring, acquisition_thread
 
 from iViewXAPI import  *
 
+# prototype of the function that iViewX calls for every new sample (see
+# iV_SetSampleCallback); the sample struct is passed by value
+if hasattr(ctypes, 'WINFUNCTYPE'):
+	samplecallbacktype = ctypes.WINFUNCTYPE(c_int, CSample)
+else:
+	samplecallbacktype = ctypes.CFUNCTYPE(c_int, CSample)
+
 # function for identyfing errors
 def errorstring(returncode):
 
@@ -124,12 +145,82 @@ def deg2pix(cmdist, angle, pixpercm):
 	return cmsize * pixpercm
 
 
+class smi_sample_ring(struct_ring):
+
+	"""A ring buffer of raw iViewX sample structs, which are copied into
+	a contiguous ctypes array and can be read as a numpy array without
+	copying; offers the same interface as samplebuffer.sample_buffer,
+	for the eye that is used by a libsmi object (internal use)"""
+
+	def __init__(self, tracker, size=8192):
+
+		"""Initializes the ring
+		
+		arguments
+		tracker	-- the libsmi object that the samples belong to
+		
+		keyword arguments
+		size		-- the number of samples that the ring can hold
+				   (default = 8192)
+		"""
+
+		struct_ring.__init__(self, CSample, size=size)
+		self.tracker = tracker
+
+	def newest(self):
+
+		"""Returns the newest sample as a tuple (see
+		sample_buffer.newest), or None if the ring is empty"""
+
+		if self.count == 0:
+			return None
+		return self.read(self.count - 1)[1]
+
+	def read(self, index):
+
+		"""Returns an (index, sample tuple) tuple (see
+		sample_buffer.read), or None"""
+
+		r = self.struct(index)
+		if r == None:
+			return None
+		return r[0], self.tracker._unpack_sample(r[1])
+
+	def window(self, since=None, n=None):
+
+		"""Returns a window of samples in the samplebuffer.SAMPLE_DTYPE
+		layout (see sample_buffer.window); the conversion from the raw
+		structs is vectorized"""
+
+		if since != None:
+			since = since * 1000 # ms to iViewX timestamp (microseconds)
+		raw = self.raw_window(since=since, n=n)
+		if self.tracker.eye_used == self.tracker.right_eye:
+			eye = self.tracker.right_eye
+			e = raw['rightEye']
+		else:
+			eye = self.tracker.left_eye
+			e = raw['leftEye']
+		x = e['gazeX']
+		y = e['gazeY']
+		samples = numpy.zeros(len(raw), dtype=SAMPLE_DTYPE)
+		samples['timestamp'] = raw['timestamp'] / 1000.0
+		samples['x'] = x
+		samples['y'] = y
+		samples['pupil'] = e['diam']
+		samples['eye'] = eye
+		samples['valid'] = ~(((x == 0) & (y == 0)) | ((x == -1) & (y == -1)))
+		samples['exptime'] = self.tracker.clock.experiment_time( \
+			samples['timestamp'])
+		return samples
+
+
 # class
 class libsmi:
 
 	"""A class for SMI eye tracker objects"""
 
-	def __init__(self, experiment, resolution, data_file=u'default', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False, ip='127.0.0.1', sendport=4444, receiveport=5555, screen_w=399, screen_h=299):
+	def __init__(self, experiment, resolution, data_file=u'default', fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, force_drift_correct=False, ip='127.0.0.1', sendport=4444, receiveport=5555, screen_w=399, screen_h=299, buffered=False, lossless=False, velocity_filter=False):
 		"""<DOC>
 		Constructor. Initializes the connection to the Eyelink.
 
@@ -159,6 +250,21 @@ class libsmi:
 		receiveport		--	port number for iViewX receiving (default = 5555)
 		screen_w		--	physical screen width in millimeters (default = 399)
 		screen_h		--	physical screen height in millimeters (default = 299)
+		buffered		--	Indicates whether samples should be acquired by a #
+							background thread and read from a ring buffer, #
+							rather than requested from iViewX on every call #
+							to sample(). (default=False)
+		lossless		--	Indicates whether iViewX should push every #
+							sample to a ring buffer through a sample #
+							callback, rather than being polled. The #
+							raw samples are then also available through #
+							get_raw_samples(). This implies buffered #
+							sampling. (default=False)
+		velocity_filter	--	Indicates whether the velocity for saccade #
+							detection should be smoothed with a #
+							Savitzky-Golay differentiator, rather than #
+							taken as the raw distance between consecutive #
+							samples. (default=False)
 		</DOC>"""
 
 		# properties
@@ -195,13 +301,39 @@ class libsmi:
 		self.errorbeep = synth(self.experiment, osc='saw', freq=100, length=100)
 		self.errdist = 2 # degrees
 		self.fixtresh = 1.5 # degrees
+		self.fixduration = 50 # milliseconds; time span over which gaze must remain within self.fixtresh for a fixation to start
 		self.spdtresh = saccade_velocity_threshold # degrees per second; saccade speed threshold
 		self.accthresh = saccade_acceleration_threshold # degrees per second**2; saccade acceleration threshold
+		self.velocity_filter = velocity_filter
+		self.sgwindow = 10 # milliseconds; time span of the samples that the Savitzky-Golay polynomial is fitted to
+		self.precisionwindow = 5000 # ms of fixation samples over which the precision (RMS noise) is estimated, after calibration as well as during detection; older samples are gradually forgotten
+		self.precision = None # precision_estimator, created in self._val
 		self.weightdist = 10 # weighted distance, used for determining whether a movement is due to measurement error (1 is ok, higher is more conservative and will result in only larger saccades to be detected)
 		self.dispsize = resolution # display size in pixels
 		self.screensize = (screen_w/10.0, screen_h/10.0) # display size in cm
-		self.prevsample = (-1,-1)
+		self.prevsample = sample_record(-1, -1, -1, -1, self.eye_used, False)
+		self.detector = None # saccade and fixation detector, created in self._val once the thresholds are known
+		self.blinkdetector = blink_detector(min_duration=50, max_duration=500) # blink duration limits in milliseconds
+		self.last_event = None # the most recent event returned by a wait_for_* function, with its time in experiment time and its peak velocity in degrees per second (see self._event_outcome)
 		self.maxtries = 100 # number of samples obtained before giving up (for obtaining accuracy and tracker distance information, as well as starting or stopping recording)
+		self.lossless = lossless
+		self.buffered = buffered or lossless
+		if self.lossless:
+			self.sample_buffer = smi_sample_ring(self) # the callback copies the raw sample structs into a ring
+		else:
+			self.sample_buffer = sample_buffer()
+		self.acquisition = None
+		self.polldata = CSample() # private sample struct for the acquisition thread, so that it doesn't share the global sampleData
+		self.samplecallback = samplecallbacktype(self._on_sample) # reference is kept, so that the callback isn't garbage collected while iViewX uses it
+		self.streaming = False # True while samples are pushed into self.sample_buffer, by the acquisition thread or the sample callback
+		self.readindex = 0 # position in self.sample_buffer of the next sample for wait_for_new_sample
+		self.lastsampletime = None # tracker timestamp of the sample returned by the previous wait_for_new_sample call
+		self.clock = clock_model() # offset between the iViewX clock and the experiment clock, used to convert sample timestamps
+		self.clocksync = None
+		self.bus = event_bus() # callbacks that have subscribed to events, see self.subscribe
+		self.monitor = None # background detection thread for subscribed events, running while recording
+		self.monitorindex = 0 # position in self.sample_buffer of the next sample for the detection thread
+		self.pollstate = None # the events and detectors of the ongoing incremental wait, see self.poll_event
 
 		# set logger
 		res = iViewXAPI.iV_SetLogger(c_int(1), c_char_p(data_file + '_SMILOG.txt'))
@@ -232,6 +364,9 @@ class libsmi:
 			print("Error in libsmi.libsmi.__init__: establishing connection failed; %s" % err)
 			self.connected = False
 
+		# decides how long to wait between two polls, based on the sample rate
+		self.scheduler = poll_scheduler(self.sampletime)
+
 		# initiation report
 		self.log("pygaze initiation report start")
 		self.log("experiment: %s" % self.description)
@@ -241,6 +376,7 @@ class libsmi:
 		self.log("samplerate: %s Hz" % self.samplerate)
 		self.log("sampletime: %s ms" % self.sampletime)
 		self.log("fixation threshold: %s degrees" % self.fixtresh)
+		self.log("fixation window: %s ms" % self.fixduration)
 		self.log("speed threshold: %s degrees/second" % self.spdtresh)
 		self.log("accuracy threshold: %s degrees/second**2" % self.accthresh)
 		self.log("pygaze initiation report end")
@@ -415,25 +551,23 @@ class libsmi:
 		self.cv.fixdot(x=None, y=None, color=self.fgc)
 		self.cv.show()
 
-		# get samples
+		# get samples, and calculate RMS noise from the distances between
+		# them; the estimator keeps being updated during fixations by the
+		# event detectors (see self.get_precision)
+		self.precision = precision_estimator(memory=max(1, int(self.precisionwindow * self.samplerate / 1000.0)))
 		self.start_recording()
-		sl = [self.sample()] # samplelist, prefilled with 1 sample to prevent sl[-1] from producing an error; first sample will be ignored for RMS calculation
+		prevsample = self.sample() # first sample is only used to recognize new samples, and is ignored for RMS calculation
+		first = True
 		t0 = self.experiment.time() # starting time
 		while self.experiment.time() - t0 < 1000:
 			s = self.sample() # sample
-			if s != sl[-1] and s != (-1,-1) and s != (0,0):
-				sl.append(s)
+			if s != prevsample and s != (-1,-1) and s != (0,0):
+				if not first:
+					self.precision.add(s[0]-prevsample[0], s[1]-prevsample[1])
+				prevsample = s
+				first = False
 		self.stop_recording()
-
-		# calculate RMS noise
-		Xvar = []
-		Yvar = []
-		for i in range(2,len(sl)):
-			Xvar.append((sl[i][0]-sl[i-1][0])**2)
-			Yvar.append((sl[i][1]-sl[i-1][1])**2)
-		XRMS = (sum(Xvar) / len(Xvar))**0.5
-		YRMS = (sum(Yvar) / len(Yvar))**0.5
-		self.pxdsttresh = (XRMS, YRMS)
+		self.pxdsttresh = self.precision.rms()
 
 		# calculate pixels per cm
 		pixpercm = (self.dispsize[0]/float(self.screensize[0]) + self.dispsize[1]/float(self.screensize[1])) / 2.0
@@ -442,7 +576,7 @@ class libsmi:
 		while res != 1 and i < self.maxtries: # multiple tries, in case no (valid) sample is available
 			res = iViewXAPI.iV_GetAccuracy(byref(accuracyData),0) # 0 is for 'no visualization'
 			i += 1
-			self.experiment.sleep(int(self.sampletime)) # wait for sampletime
+			time.sleep(self.sampletime / 1000.0) # wait for sampletime
 		if res == 1:
 			self.accuracy = ((accuracyData.deviationLX,accuracyData.deviationLY), (accuracyData.deviationLX,accuracyData.deviationLY)) # dsttresh = (left tuple, right tuple); tuple = (horizontal deviation, vertical deviation) in degrees of visual angle
 		else:
@@ -455,7 +589,7 @@ class libsmi:
 		while res != 1 and i < self.maxtries: # multiple tries, in case no (valid) sample is available
 			res = iViewXAPI.iV_GetSample(byref(sampleData))
 			i += 1
-			self.experiment.sleep(int(self.sampletime)) # wait for sampletime
+			time.sleep(self.sampletime / 1000.0) # wait for sampletime
 		if res == 1:
 			screendist = sampleData.leftEye.eyePositionZ / 10.0 # eyePositionZ is in mm; screendist is in cm
 		else:
@@ -469,6 +603,12 @@ class libsmi:
 		self.pxaccuracy = ((deg2pix(screendist, self.accuracy[0][0], pixpercm),deg2pix(screendist, self.accuracy[0][1], pixpercm)), (deg2pix(screendist, self.accuracy[1][0], pixpercm),deg2pix(screendist, self.accuracy[1][1], pixpercm)))
 		self.pxspdtresh = deg2pix(screendist, self.spdtresh/float(self.samplerate), pixpercm) # in pixels per sample
 		self.pxacctresh = deg2pix(screendist, self.accthresh/float(self.samplerate**2), pixpercm) # in pixels per sample**2
+		self.pixperdeg = deg2pix(screendist, 1, pixpercm) # for offline analysis of the samples (see gazeanalysis) and the peak velocity of detected saccades
+		if self.velocity_filter:
+			# the coefficients only depend on the number of samples in the
+			# window, so they are computed once for the current sample rate
+			self.sgcoefficients = savitzky_golay_coefficients(max(5, int(round(self.sgwindow * self.samplerate / 1000.0))))
+		self.detector = self._make_detector(precision=self.precision)
 
 		# calibration report
 		self.log("pygaze calibration report start")
@@ -479,6 +619,8 @@ class libsmi:
 		self.log("fixation threshold: %s pixels" % self.pxfixtresh)
 		self.log("speed threshold: %s pixels/sample" % self.pxspdtresh)
 		self.log("accuracy threshold: %s pixels/sample**2" % self.pxacctresh)
+		if self.velocity_filter:
+			self.log("velocity filter: Savitzky-Golay, %s samples" % len(self.sgcoefficients))
 		self.log("pygaze calibration report end")
 
 		return True, "validation was successful"
@@ -498,6 +640,32 @@ class libsmi:
 		########
 
 
+	def _make_detector(self, precision=None):
+
+		"""Creates a saccade and fixation detector with the thresholds
+		that were determined by self._val; for internal use
+		
+		keyword arguments
+		precision	-- the precision_estimator that the detector updates
+				   during fixations, or None for a detector that uses
+				   the current precision as a fixed noise level
+				   (default = None)
+		
+		returns
+		detector	-- an eventdetection.event_detector
+		"""
+
+		if self.velocity_filter:
+			differentiator = sg_differentiator(self.sgcoefficients)
+		else:
+			differentiator = None
+		if precision == None and self.detector != None:
+			dsttresh = self.detector.dsttresh
+		else:
+			dsttresh = self.pxdsttresh
+		return event_detector(self.pxspdtresh, self.pxacctresh, self.pxfixtresh, dsttresh=dsttresh, weightdist=self.weightdist, fixduration=self.fixduration, differentiator=differentiator, precision=precision)
+
+
 	def close(self):
 
 		"""Neatly close connection to tracker
@@ -545,6 +713,23 @@ class libsmi:
 		return self.connected
 
 
+	def dispatch_events(self):
+
+		"""Calls the callbacks that subscribed to events with
+		main_loop=True, for the events that were detected since the
+		previous call (see self.subscribe); this should be called
+		regularly from the main loop
+		
+		arguments
+		None
+		
+		returns
+		n		-- the number of callbacks that were called
+		"""
+
+		return self.bus.dispatch()
+
+
 	def drift_correction(self, pos=None, fix_triggered=False):
 
 		"""Performs a drift check
@@ -646,9 +831,43 @@ class libsmi:
 
 	def get_eyelink_clock_async(self):
 
-		"""Not supported for libsmi"""
+		"""Returns the difference between the iViewX clock and the
+		experiment clock, according to the clock model that is kept up
+		to date while recording; 0 if no measurement has been made yet
+		
+		arguments
+		None
+		
+		returns
+		offset	-- iViewX time minus experiment time (in milliseconds)
+		"""
+
+		return self.clock.offset()
+
+
+	def _measure_clock(self):
+
+		"""Measures the offset between the iViewX clock and the
+		experiment clock once; for use by the clock synchronization
+		thread
+		
+		arguments
+		None
+		
+		returns
+		measurement	-- a (tracker time, experiment time, roundtrip)
+				   tuple in milliseconds, or None if the iViewX
+				   timestamp could not be obtained
+		"""
 
-		return 0
+		timestamp = c_longlong()
+		t0 = self.experiment.time()
+		res = iViewXAPI.iV_GetCurrentTimestamp(byref(timestamp))
+		t1 = self.experiment.time()
+		if res != 1:
+			return None
+
+		return timestamp.value / 1000.0, (t0 + t1) / 2.0, t1 - t0
 
 	def log(self, msg):
 
@@ -753,6 +972,76 @@ class libsmi:
 
 		pass
 
+	def poll_event(self, event, restart=False):
+
+		"""Checks whether an event has occurred, without waiting; this
+		is the incremental form of wait_for_event, which can be called
+		once per display frame, so that the display keeps being updated
+		while waiting for an event; the first call for an event, the
+		first call after the event was returned, and the first call
+		after start_recording or a wait_for_* function, starts a new
+		wait (as if wait_for_event was called); every call processes all
+		buffered samples that arrived since the previous call, and then
+		returns immediately; this requires buffered (or lossless)
+		sampling, because the event detectors need every sample rather
+		than one sample per display frame
+		
+		arguments
+		event		-- an integer event code (see wait_for_event)
+		
+		keyword arguments
+		restart	-- indicates whether a new wait should be started, for
+				   example at the start of a trial, even if the previous
+				   call was for the same event (default = False)
+		
+		returns
+		outcome	-- the return values of the self.wait_for_* method
+				   that corresponds to the specified event, or None
+				   if the event hasn't occurred (yet)
+		"""
+
+		outcome = self.poll_any([event], restart=restart)
+		if outcome == None:
+			return None
+
+		return outcome[1]
+
+
+	def poll_any(self, events, restart=False):
+
+		"""Checks whether any of a number of events has occurred,
+		without waiting; this is the incremental form of wait_for_any
+		(see poll_event)
+		
+		arguments
+		events	-- a list of integer event codes (see wait_for_event)
+		
+		keyword arguments
+		restart	-- indicates whether a new wait should be started (see
+				   poll_event) (default = False)
+		
+		returns
+		outcome	-- an (event, outcome) tuple as returned by
+				   wait_for_any, or None if none of the events has
+				   occurred (yet)
+		"""
+
+		if not self.buffered:
+			raise exceptions.runtime_error( \
+				u'Error in libsmi.libsmi.poll_any: polling for events requires buffered sampling')
+		events = frozenset(events)
+		if restart or self.pollstate == None or self.pollstate[0] != events:
+			self.pollstate = events, self._start_detection(events)
+		while True:
+			s = self.wait_for_new_sample(timeout=0)
+			if s == None:
+				return None
+			e = self._detect(self.pollstate[1], events, s)
+			if e != None:
+				self.pollstate = None
+				return e.type, self._event_outcome(e)
+
+
 	def pupil_size(self):
 
 		"""<DOC>
@@ -766,20 +1055,8 @@ class libsmi:
 		Raises an exceptions.runtime_error on failure.
 		</DOC>
 		"""
-		
-		if not self.recording:
-			raise exceptions.runtime_error( \
-				u'Please start recording before collecting eyetracker data')
 
-		res = iViewXAPI.iV_GetSample(byref(sampleData))
-
-		if res == 1:
-			if self.eye_used == self.left_eye or self.eye_used == self.binocular:
-				return float(sampleData.leftEye.diam)
-			elif self.eye_used == self.right_eye:
-				return float(sampleData.rightEye.diam)
-		else:
-			return -1
+		return float(self.sample_full().pupil)
 
 
 	def sample(self):
@@ -794,27 +1071,400 @@ class libsmi:
 		Exceptions:
 		Raises an exceptions.runtime_error on failure.
 		</DOC>"""
+
+		s = self.sample_full()
+		return s.x, s.y
+
+
+	def sample_full(self):
+
+		"""Returns the most recent sample, including the pupil size; the
+		gaze position and pupil size are obtained with a single call to
+		iV_GetSample, so they always belong to the same sample
 		
+		arguments
+		None
+		
+		returns
+		sample	-- a sample_record with the attributes timestamp (tracker
+				   time in milliseconds), x, y, pupil, eye and valid; if
+				   no new data is available, the previous sample is
+				   returned
+		
+		exceptions
+		Raises an exceptions.runtime_error when not recording.
+		"""
+
 		if not self.recording:
 			raise exceptions.runtime_error( \
 				u'Please start recording before collecting eyetracker data')
 
-		res = iViewXAPI.iV_GetSample(byref(sampleData))
+		if self.streaming:
+			s = self.sample_buffer.newest()
+			if s == None:
+				return self.prevsample
+			return sample_record(*s)
 
-		if self.eye_used == self.right_eye:
-			newsample = sampleData.rightEye.gazeX, sampleData.rightEye.gazeY
-		else:
-			newsample = sampleData.leftEye.gazeX, sampleData.leftEye.gazeY
+		res = iViewXAPI.iV_GetSample(byref(sampleData))
 
 		if res == 1:
-			self.prevsample = newsample[:]
-			return newsample
+			self.prevsample = sample_record(*self._unpack_sample(sampleData))
+			return self.prevsample
 		elif res == 2: # no new data
 			return self.prevsample
 		else:
 #			err = errorstring(res)
 #			print("Error in libsmi.libsmi.sample: failed to obtain sample; %s" % err)
-			return (-1,-1)
+			return sample_record(-1, -1, -1, -1, self.eye_used, False)
+
+
+	def wait_for_new_sample(self, timeout=None):
+
+		"""Waits until a sample is available that is newer than the one
+		returned by the previous call; until shortly before the next
+		sample can be expected (one self.sampletime after the previous
+		one), waiting sleeps rather than polls, so that it doesn't occupy
+		the CPU (see pollscheduler.poll_scheduler); with
+		buffered or lossless sampling, every buffered sample is returned
+		in order
+		
+		arguments
+		None
+		
+		keyword arguments
+		timeout	-- the maximum waiting time in milliseconds, or None to
+				   wait indefinitely (default = None)
+		
+		returns
+		sample	-- a sample_record, or None if the timeout expired
+		"""
+
+		deadline = to_deadline(timeout)
+		while True:
+			# when samples are streamed into the buffer, every sample is
+			# read in order; otherwise, only the newest sample is available
+			if self.streaming:
+				r = self.sample_buffer.read(self.readindex)
+				now = default_timer()
+				if r != None:
+					self.readindex = r[0] + 1
+					self.scheduler.arrived(now)
+					return sample_record(*r[1])
+			else:
+				s = self.sample_full()
+				now = default_timer()
+				if s.timestamp != self.lastsampletime:
+					self.lastsampletime = s.timestamp
+					self.scheduler.arrived(now)
+					return s
+			if deadline != None and now >= deadline:
+				return None
+			self.scheduler.pause(deadline)
+
+
+	def _skip_to_newest_sample(self):
+
+		"""Makes wait_for_new_sample ignore the samples that are
+		currently in the buffer, so that event detection starts with
+		samples that arrive from now on; for internal use
+		"""
+
+		self.readindex = self.sample_buffer.count
+
+
+	def _wait_for_detected_event(self, events, timeout=None, abort_check=None):
+
+		"""Feeds new samples to the event detectors until one of them
+		detects an event of any of the specified types; detection starts
+		with the samples that arrive from now on; for internal use by
+		the wait_for_* functions
+		
+		arguments
+		events	-- a list of eventdetection event codes, such as
+				   [STARTSACC]; offsets (ENDSACC, ENDFIX and ENDBLINK)
+				   are only detected after the corresponding onset
+		
+		keyword arguments
+		timeout	-- the maximum waiting time in milliseconds, or None to
+				   wait indefinitely (default = None)
+		abort_check	-- a function that is called for every sample, and
+				   at least every 10 ms when no samples arrive, and
+				   which returns True to stop waiting (default = None)
+		
+		returns
+		event		-- an eventdetection.gaze_event, or None if the
+				   timeout expired or abort_check returned True first
+		"""
+
+		# a blocking wait ends the ongoing incremental wait
+		self.pollstate = None
+		events = frozenset(events)
+		detectors = self._start_detection(events)
+		deadline = to_deadline(timeout)
+		while True:
+			if stop_waiting(deadline, abort_check):
+				return None
+			# when samples stop arriving (e.g. because the tracker is
+			# paused), abort_check must still be called regularly
+			wait = time_left(deadline)
+			if abort_check != None and (wait == None or wait > 10):
+				wait = 10
+			s = self.wait_for_new_sample(timeout=wait)
+			if s == None:
+				continue
+			e = self._detect(detectors, events, s)
+			if e != None:
+				return e
+
+
+	def _start_detection(self, events):
+
+		"""Prepares the event detectors for a new wait, which starts
+		with the samples that arrive from now on; for internal use
+		
+		arguments
+		events	-- a frozenset of eventdetection event codes
+		
+		returns
+		detectors	-- a list of the detectors that detect the events
+		"""
+
+		for event in events:
+			if event not in (STARTBLINK, ENDBLINK, STARTSACC, ENDSACC, STARTFIX, ENDFIX):
+				raise exceptions.runtime_error( \
+					u'Error in libsmi.libsmi: unknown event %s' % event)
+		# blinks are detected from missing data, which doesn't require the
+		# thresholds that are determined during calibration
+		detectors = []
+		if events & frozenset((STARTBLINK, ENDBLINK)):
+			detectors.append(self.blinkdetector)
+		if events - frozenset((STARTBLINK, ENDBLINK)):
+			if self.detector == None:
+				raise exceptions.runtime_error( \
+					u'Error in libsmi.libsmi: event detection requires a calibration')
+			detectors.append(self.detector)
+		self._skip_to_newest_sample()
+		for detector in detectors:
+			detector.reset()
+
+		return detectors
+
+
+	def _detect(self, detectors, events, s):
+
+		"""Feeds a sample to the event detectors; for internal use
+		
+		arguments
+		detectors	-- a list of detectors from self._start_detection
+		events	-- a frozenset of eventdetection event codes
+		s		-- a sample_record
+		
+		returns
+		event		-- the first eventdetection.gaze_event of any of
+				   the specified types, or None
+		"""
+
+		# a pupil diameter of 0 also indicates missing data
+		valid = s.valid and s.pupil != 0
+		for detector in detectors:
+			for e in detector.update(s.timestamp, s.x, s.y, valid):
+				if e.type in events:
+					return e
+
+		return None
+
+
+	def _event_outcome(self, e, last=True):
+
+		"""Converts a detected event into the return value of the
+		corresponding wait_for_* function; the time is that of the
+		sample at which the event occurred (e.g. the first sample that
+		exceeded the saccade thresholds), converted from iViewX time to
+		experiment time, so that it doesn't include the delay before
+		the event was noticed; the event is also stored, with
+		its time in experiment time and its peak velocity in degrees
+		per second, as self.last_event; for internal use
+		
+		arguments
+		e		-- an eventdetection.gaze_event
+		
+		keyword arguments
+		last		-- indicates whether the event should be stored as
+				   self.last_event (default = True)
+		
+		returns
+		outcome	-- the time (for blinks), the time and starting
+				   position (for onsets and fixation ends) or the time,
+				   starting and end position (for saccade ends)
+		"""
+
+		t = self.clock.experiment_time(e.timestamp)
+		peakvelocity = None
+		if e.peakvelocity != None:
+			peakvelocity = e.peakvelocity * self.samplerate / self.pixperdeg
+		if last:
+			self.last_event = gaze_event(e.type, t, e.startpos, e.endpos, peakvelocity=peakvelocity)
+		if e.type in (STARTBLINK, ENDBLINK):
+			return t
+		if e.type == ENDSACC:
+			return t, e.startpos, e.endpos
+		return t, e.startpos
+
+
+	def _unpack_sample(self, data):
+
+		"""Converts an iViewX sample struct for the eye that is used;
+		for internal use
+		
+		arguments
+		data		-- a CSample struct, as filled by iV_GetSample
+		
+		returns
+		sample	-- a (timestamp, x, y, pupil, eye, valid, exptime) tuple,
+				   with the timestamp in milliseconds of iViewX time
+				   and exptime in milliseconds of experiment time
+		"""
+
+		if self.eye_used == self.right_eye:
+			eye = self.right_eye
+			e = data.rightEye
+		else:
+			eye = self.left_eye
+			e = data.leftEye
+		x, y = e.gazeX, e.gazeY
+		valid = (x, y) != (0,0) and (x, y) != (-1,-1)
+
+		timestamp = data.timestamp / 1000.0
+
+		return timestamp, x, y, e.diam, eye, valid, \
+			self.clock.experiment_time(timestamp)
+
+
+	def _poll_sample(self):
+
+		"""Gets the newest sample from iViewX; for use by the acquisition
+		thread
+		
+		arguments
+		None
+		
+		returns
+		sample	-- a (timestamp, x, y, pupil, eye, valid, exptime) tuple
+				   (see _unpack_sample), or None if no sample is
+				   available
+		"""
+
+		res = iViewXAPI.iV_GetSample(byref(self.polldata))
+		if res != 1:
+			return None
+
+		return self._unpack_sample(self.polldata)
+
+
+	def _on_sample(self, data):
+
+		"""Copies a sample struct into the sample ring; called by
+		iViewX for every new sample when lossless sampling is enabled
+		
+		arguments
+		data		-- a CSample struct
+		
+		returns
+		1		-- the return value that iViewX expects
+		"""
+
+		self.sample_buffer.push(data)
+		return 1
+
+
+	def get_precision(self):
+
+		"""Returns the current precision of the gaze signal; the
+		precision is measured during the noise calibration in
+		self.calibrate, and is then kept up to date with the samples
+		during fixations that the event detectors process, so that the
+		saccade detection threshold (self.weightdist times the noise
+		level) follows changes in noise over a session
+		
+		arguments
+		None
+		
+		returns
+		precision	-- an (x, y) tuple with the RMS distance between
+				   consecutive samples in pixels, or None before
+				   calibration
+		"""
+
+		if self.detector == None:
+			return None
+
+		return self.detector.dsttresh
+
+
+	def get_samples(self, since=None, n=None):
+
+		"""Returns a window of buffered samples; requires buffered
+		sampling (see the buffered keyword of the constructor)
+		
+		arguments
+		None
+		
+		keyword arguments
+		since		-- a tracker timestamp in milliseconds; only samples
+					   that are more recent are returned, or None for
+					   no limit (default = None)
+		n			-- the maximum number of (most recent) samples to
+					   return, or None for no limit (default = None)
+		
+		returns
+		samples	-- a structured numpy array with the fields timestamp,
+				   x, y, pupil, eye, valid and exptime (the timestamp
+				   in experiment time), in chronological order
+		
+		exceptions
+		Raises an exceptions.runtime_error if buffered sampling is disabled.
+		"""
+
+		if not self.buffered:
+			raise exceptions.runtime_error( \
+				u'get_samples() requires buffered sampling')
+		return self.sample_buffer.window(since=since, n=n)
+
+
+	def get_raw_samples(self, since=None, n=None):
+
+		"""Returns a window of raw iViewX sample structs as a numpy
+		array, without copying; requires lossless sampling (see the
+		lossless keyword of the constructor)
+		
+		arguments
+		None
+		
+		keyword arguments
+		since		-- a tracker timestamp in milliseconds; only samples
+					   that are more recent are returned, or None for
+					   no limit (default = None)
+		n			-- the maximum number of (most recent) samples to
+					   return, or None for no limit (default = None)
+		
+		returns
+		samples	-- a structured numpy array with the same layout as
+				   the iViewX sample struct (timestamp in microseconds,
+				   leftEye and rightEye with gazeX, gazeY, diam, etc.);
+				   this is a view on the ring buffer when possible, so
+				   copy it if it needs to outlive the next few seconds
+				   of recording
+		
+		exceptions
+		Raises an exceptions.runtime_error if lossless sampling is disabled.
+		"""
+
+		if not self.lossless:
+			raise exceptions.runtime_error( \
+				u'get_raw_samples() requires lossless sampling')
+		if since != None:
+			since = since * 1000 # ms to iViewX timestamp (microseconds)
+		return self.sample_buffer.raw_window(since=since, n=n)
 
 
 	def send_command(self, cmd):
@@ -881,6 +1531,31 @@ class libsmi:
 		
 		if res == 1:
 			self.recording = True
+			self.pollstate = None # an incremental wait doesn't continue into a new recording
+			self.scheduler.start()
+			# resynchronize the clock model, and keep it up to date in the
+			# background, so that sample timestamps can be converted to
+			# experiment time without talking to iViewX
+			if self.clocksync == None:
+				synchronize(self._measure_clock, self.clock)
+				self.clocksync = clock_sync_thread(self._measure_clock, self.clock)
+				self.clocksync.start()
+			# optionally let iViewX push samples to us, or start acquiring
+			# samples in the background
+			if self.buffered and not self.streaming:
+				self.sample_buffer.clear()
+				self.readindex = 0
+				if self.lossless:
+					res = iViewXAPI.iV_SetSampleCallback(self.samplecallback)
+					if res != 1:
+						err = errorstring(res)
+						raise exceptions.runtime_error( \
+							u'Error in libsmi.libsmi.start_recording: failed to set sample callback; %s' % err)
+				else:
+					self.acquisition = acquisition_thread(self._poll_sample, self.sample_buffer)
+					self.acquisition.start()
+				self.streaming = True
+			self._start_monitor()
 		else:
 			self.recording = False
 			err = errorstring(res)
@@ -907,6 +1582,18 @@ class libsmi:
 				   successfully started
 		"""
 
+		self._stop_monitor()
+		if self.acquisition != None:
+			self.acquisition.stop()
+			self.acquisition = None
+		if self.clocksync != None:
+			self.clocksync.stop()
+			self.clocksync = None
+		self.scheduler.stop()
+		if self.streaming and self.lossless:
+			iViewXAPI.iV_SetSampleCallback(None)
+		self.streaming = False
+
 		res = 0; i = 0
 		while res != 1 and i < self.maxtries:
 			res = iViewXAPI.iV_StopRecording()
@@ -920,25 +1607,165 @@ class libsmi:
 				u'Error in libsmi.libsmi.stop_recording: %s' %err)
 
 
-	def wait_for_blink_end(self):
+	def subscribe(self, event, callback, main_loop=False):
+
+		"""Subscribes a callback to an event, so that the event can be
+		reacted to without blocking in a wait_for_* function; while
+		recording, a background thread feeds the buffered samples to its
+		own event detectors, and publishes the events as they are
+		detected; this requires buffered (or lossless) sampling, so that
+		the thread doesn't take samples away from the wait_for_*
+		functions; the saccade detector of the thread uses the precision
+		at the time the thread starts as a fixed noise level, so that
+		samples aren't counted twice by the precision estimator
+		
+		arguments
+		event		-- an integer event code (see wait_for_event)
+		callback	-- a function that is called with the event code and
+				   the outcome of the event (as returned by
+				   wait_for_event) as arguments
+		
+		keyword arguments
+		main_loop	-- if False, the callback is called from the
+				   background thread, so it shouldn't use the display;
+				   if True, the callback is queued until the main loop
+				   calls self.dispatch_events (default = False)
+		
+		returns
+		subscription	-- a subscription id for self.unsubscribe
+		"""
+
+		if not self.buffered:
+			raise exceptions.runtime_error( \
+				u'Error in libsmi.libsmi.subscribe: subscribing to events requires buffered sampling')
+		if event not in (STARTBLINK, ENDBLINK, STARTSACC, ENDSACC, STARTFIX, ENDFIX):
+			raise exceptions.runtime_error( \
+				u'Error in libsmi.libsmi.subscribe: unknown event %s' % event)
+		if event not in (STARTBLINK, ENDBLINK) and self.detector == None:
+			raise exceptions.runtime_error( \
+				u'Error in libsmi.libsmi: event detection requires a calibration')
+		subscription = self.bus.subscribe(event, callback, main_loop=main_loop)
+		# the detectors are created when the thread starts, so a
+		# running thread is restarted to include a new saccade or
+		# fixation detector
+		if self.recording:
+			self._stop_monitor()
+			self._start_monitor()
+
+		return subscription
+
+
+	def unsubscribe(self, subscription):
+
+		"""Removes a subscription that was made with self.subscribe
+		
+		arguments
+		subscription	-- a subscription id
+		
+		returns
+		Nothing
+		"""
+
+		self.bus.unsubscribe(subscription)
+		if len(self.bus.events()) == 0:
+			self._stop_monitor()
+
+
+	def _start_monitor(self):
+
+		"""Starts the background detection thread for subscribed events,
+		if there are any; the thread starts with the samples that arrive
+		from now on; for internal use
+		"""
 
-		"""Not supported for libsmi (yet)"""
+		events = self.bus.events()
+		if self.monitor != None or len(events) == 0:
+			return
+		detectors = []
+		if events & frozenset((STARTBLINK, ENDBLINK)):
+			detectors.append(blink_detector(min_duration=self.blinkdetector.min_duration, max_duration=self.blinkdetector.max_duration))
+		if events - frozenset((STARTBLINK, ENDBLINK)):
+			detectors.append(self._make_detector())
+		self.monitorindex = self.sample_buffer.count
+		self.monitor = detection_thread(self._next_monitor_sample, detectors, self.bus, lambda e: self._event_outcome(e, last=False))
+		self.monitor.start()
 
-		print("libsmi.wait_for_blink_end: function not supported yet")
+
+	def _stop_monitor(self):
+
+		"""Stops the background detection thread; for internal use"""
+
+		if self.monitor != None:
+			self.monitor.stop()
+			self.monitor = None
+
+
+	def _next_monitor_sample(self):
+
+		"""Gets the next buffered sample for the background detection
+		thread, which reads the buffer with its own index, so that it
+		doesn't interfere with the samples that wait_for_new_sample
+		returns; for internal use
 		
-		return self.experiment.time()
+		returns
+		sample	-- a sample_record, or None if no new sample is
+				   available
+		"""
 
+		r = self.sample_buffer.read(self.monitorindex)
+		if r == None:
+			return None
+		self.monitorindex = r[0] + 1
+		s = sample_record(*r[1])
+		# a pupil diameter of 0 also indicates missing data
+		if s.pupil == 0:
+			s.valid = False
+
+		return s
 
-	def wait_for_blink_start(self):
 
-		"""Not supported for libsmi (yet)"""
+	def wait_for_blink_end(self):
+
+		"""Returns the ending time of a blink; a blink is a run of
+		missing data (no gaze position or pupil) that lasts between
+		self.blinkdetector.min_duration and max_duration milliseconds
+		(see eventdetection.blink_detector)
+		
+		arguments
+		None
+		
+		returns
+		time		-- the time of the first valid sample after the blink,
+				   in milliseconds (from expstart)
+		"""
+
+		e = self._wait_for_detected_event([ENDBLINK])
+
+		return self._event_outcome(e)
 
-		print("libsmi.wait_for_blink_start: function not supported yet")
+
+	def wait_for_blink_start(self):
+
+		"""Returns the starting time of a blink; a blink is a run of
+		missing data (no gaze position or pupil) that lasts between
+		self.blinkdetector.min_duration and max_duration milliseconds
+		(see eventdetection.blink_detector); the blink is only reported
+		once it has lasted the minimum duration
+		
+		arguments
+		None
 		
-		return self.experiment.time()
+		returns
+		time		-- the time of the first missing sample of the blink,
+				   in milliseconds (from expstart)
+		"""
+
+		e = self._wait_for_detected_event([STARTBLINK])
+
+		return self._event_outcome(e)
 
 
-	def wait_for_event(self, event):
+	def wait_for_event(self, event, timeout=None, abort_check=None):
 
 		"""Waits for event
 		
@@ -951,26 +1778,56 @@ class libsmi:
 					7 = STARTFIX
 					8 = ENDFIX
 		
+		keyword arguments
+		timeout	-- the maximum waiting time in milliseconds, or None to
+				   wait indefinitely (default = None)
+		abort_check	-- a function that is called for every sample, and
+				   which returns True to stop waiting, for example
+				   because a response was collected (default = None)
+		
+		returns
+		outcome	-- the return values of the self.wait_for_* method
+				   that corresponds to the specified event, or None
+				   if the timeout expired or abort_check returned True
+				   before the event occurred
+		"""
+
+		outcome = self.wait_for_any([event], timeout=timeout, abort_check=abort_check)
+		if outcome == None:
+			return None
+
+		return outcome[1]
+
+
+	def wait_for_any(self, events, timeout=None, abort_check=None):
+
+		"""Waits for the first of a number of events; all events are
+		detected from the same samples, so that none of them can be
+		missed while waiting for another
+		
+		arguments
+		events	-- a list of integer event codes (see wait_for_event)
+		
+		keyword arguments
+		timeout	-- the maximum waiting time in milliseconds, or None to
+				   wait indefinitely (default = None)
+		abort_check	-- a function that is called for every sample, and
+				   which returns True to stop waiting, for example
+				   because a response was collected (default = None)
+		
 		returns
-		outcome	-- a self.wait_for_* method is called, depending on the
-				   specified event; the return values of corresponding
-				   method are returned
+		outcome	-- an (event, outcome) tuple for the first event that
+				   occurred, where outcome is as returned by
+				   wait_for_event, or None if the timeout expired or
+				   abort_check returned True before any of the events
+				   occurred
 		"""
 
-		if event == 5:
-			outcome = self.wait_for_saccade_start()
-		elif event == 6:
-			outcome = self.wait_for_saccade_end()
-		elif event == 7:
-			outcome = self.wait_for_fixation_start()
-		elif event == 8:
-			outcome = self.wait_for_fixation_end()
-		elif event == 3:
-			outcome = self.wait_for_blink_start()
-		elif event == 4:
-			outcome = self.wait_for_blink_end()
+		e = self._wait_for_detected_event(events, timeout=timeout, abort_check=abort_check)
+		if e == None:
+			return None
 
-		return outcome
+		return e.type, self._event_outcome(e)
 
 
 	def wait_for_fixation_end(self):
@@ -979,7 +1836,8 @@ class libsmi:
 		function assumes that a 'fixation' has ended when a deviation of
 		more than self.pxfixtresh from the initial fixation position has
 		been detected (self.pxfixtresh is created in self.calibration,
-		based on self.fixtresh, a property defined in self.__init__)
+		based on self.fixtresh, a property defined in self.__init__);
+		see eventdetection.event_detector
 		
 		arguments
 		None
@@ -991,18 +1849,9 @@ class libsmi:
 					   was initiated
 		"""
 
-		# function assumes that a 'fixation' has ended when a deviation of more than maxerr
-		# from the initial 'fixation' position has been detected (using Pythagoras, ofcourse)
-
-		stime, spos = self.wait_for_fixation_start()
-		
-		while True:
-			npos = self.sample() # get newest sample
-			if npos != (0,0):
-				if ((spos[0]-npos[0])**2  + (spos[1]-npos[1])**2)**0.5 > self.pxfixtresh: # Pythagoras
-					break
+		e = self._wait_for_detected_event([ENDFIX])
 
-		return self.experiment.time(), spos
+		return self._event_outcome(e)
 
 
 	def wait_for_fixation_start(self):
@@ -1010,9 +1859,10 @@ class libsmi:
 		"""Returns starting time and position when a fixation is started;
 		function assumes a 'fixation' has started when gaze position
 		remains reasonably stable (i.e. when most deviant samples are
-		within self.pxfixtresh) for five samples in a row (self.pxfixtresh
-		is created in self.calibration, based on self.fixtresh, a property
-		defined in self.__init__)
+		within self.pxfixtresh) for self.fixduration milliseconds
+		(self.pxfixtresh is created in self.calibration, based on
+		self.fixtresh, a property defined in self.__init__); see
+		eventdetection.event_detector
 		
 		arguments
 		None
@@ -1024,33 +1874,17 @@ class libsmi:
 					   was initiated
 		"""
 
-		# function assumes a 'fixation' has started when gaze position remains reasonably
-		# stable for five samples in a row
-		
-		# wait for reasonably stable position
-		xl = [] # list for last five samples (x coordinate)
-		yl = [] # list for last five samples (y coordinate)
-		moving = True
-		while moving:
-			npos = self.sample()
-			if npos != (0,0):
-				xl.append(npos[0]) # add newest sample
-				yl.append(npos[1]) # add newest sample
-				if len(xl) == 5:
-					# check if deviation is small enough
-					if ((max(xl)-min(xl))**2 + (max(yl)-min(yl))**2)**0.5 < self.pxfixtresh:
-						moving = False
-					# remove oldest sample
-					xl.pop(0); yl.pop(0)
+		e = self._wait_for_detected_event([STARTFIX])
 
-		return self.experiment.time(), (xl[-1],yl[-1])
+		return self._event_outcome(e)
 
 
 	def wait_for_saccade_end(self):
 
 		"""Returns ending time, starting and end position when a saccade is
 		ended; based on Dalmaijer et al. (2013) online saccade detection
-		algorithm
+		algorithm (see eventdetection.event_detector); the peak velocity
+		of the saccade is available as self.last_event.peakvelocity
 		
 		arguments
 		None
@@ -1061,41 +1895,16 @@ class libsmi:
 							   are (x,y) gaze position tuples
 		"""
 
-		# NOTE: v in px/sample = s
-		# NOTE: a in px/sample**2 = v1 - v0
-
-		# METHOD 2
-		# get starting position (no blinks)
-		stime, spos = self.wait_for_saccade_start()
-		prevpos = self.sample()
-		s0 = ((prevpos[0]-spos[0])**2 + (prevpos[1]-spos[1])**2)**0.5 # = intersample distance = speed in px/sample
-
-		# get samples
-		saccadic = True
-		while saccadic:
-			# get new sample
-			newpos = self.sample()
-			if sum(newpos) > 0 and newpos != prevpos:
-				# calculate distance
-				s1 = ((newpos[0]-prevpos[0])**2 + (newpos[1]-prevpos[1])**2)**0.5 # = speed in pixels/sample
-				# calculate acceleration
-				a = s1-s0 # acceleration in pixels/sample**2 (actually is v1-v0 / t1-t0; but t1-t0 = 1 sample)
-				if s1 < self.pxspdtresh and (a > -1*self.pxacctresh and a < 0):
-					saccadic = False
-					epos = newpos[:]
-					etime = self.experiment.time()
-				s0 = copy.copy(s1)
-			# udate previous sample
-			prevpos = newpos[:]
-
-		return etime, spos, epos
+		e = self._wait_for_detected_event([ENDSACC])
+
+		return self._event_outcome(e)
 
 
 	def wait_for_saccade_start(self):
 
 		"""Returns starting time and starting position when a saccade is
 		started; based on Dalmaijer et al. (2013) online saccade detection
-		algorithm
+		algorithm (see eventdetection.event_detector)
 		
 		arguments
 		None
@@ -1105,33 +1914,6 @@ class libsmi:
 					   startpos is an (x,y) gaze position tuple
 		"""
 
-		# get starting position (no blinks)
-		newpos = self.sample()
-		while sum(newpos) == 0:
-			newpos = self.sample()
-		prevpos = newpos[:]
-		s0 = 0
-
-		# get samples
-		saccadic = False
-		while not saccadic:
-			# get new sample
-			newpos = self.sample()
-			if sum(newpos) > 0 and newpos != prevpos:
-				# check if distance is larger than accuracy error
-				sx = newpos[0]-prevpos[0]; sy = newpos[1]-prevpos[1]
-				if (sx/self.pxdsttresh[0])**2 + (sy/self.pxdsttresh[1])**2 > self.weightdist: # weigthed distance: (sx/tx)**2 + (sy/ty)**2 > 1 means movement larger than RMS noise
-					# calculate distance
-					s1 = ((sx)**2 + (sy)**2)**0.5 # intersampledistance = speed in pixels/sample
-					# calculate acceleration
-					a = s1-s0 # acceleration in pixels/sample**2 (actually is v1-v0 / t1-t0; but t1-t0 = 1 sample)
-					if s1 > self.pxspdtresh or a > self.pxacctresh:
-						saccadic = True
-						spos = prevpos[:]
-						stime = self.experiment.time()
-					s0 = copy.copy(s1)
-
-				# udate previous sample
-				prevpos = newpos[:]
-
-		return stime, spos
+		e = self._wait_for_detected_event([STARTSACC])
+
+		return self._event_outcome(e)
@@ -0,0 +1,194 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+from timeit import default_timer
+
+# The shortest time (s) that time.sleep() can reliably sleep. On Windows, this
+# is only reached after the system timer resolution has been raised to 1 ms
+# (see poll_scheduler.start()).
+if sys.platform == 'win32':
+	SLEEP_GRANULARITY = .001
+else:
+	SLEEP_GRANULARITY = .0002
+
+def to_deadline(timeout):
+
+	"""
+	Converts a timeout into a deadline.
+
+	Arguments:
+	timeout	--	A timeout in ms, or None for no timeout.
+
+	Returns:
+	The time according to timeit.default_timer at which the timeout expires, #
+	or None for no timeout.
+	"""
+
+	if timeout == None:
+		return None
+	return default_timer() + timeout / 1000.
+
+def time_left(deadline):
+
+	"""
+	Arguments:
+	deadline	--	A deadline from to_deadline().
+
+	Returns:
+	The time until the deadline in ms (at least 0), or None for no deadline.
+	"""
+
+	if deadline == None:
+		return None
+	return max(0, (deadline - default_timer()) * 1000)
+
+def stop_waiting(deadline, abort_check=None):
+
+	"""
+	Checks whether a wait should end without the awaited event.
+
+	Arguments:
+	deadline	--	A deadline from to_deadline().
+
+	Keyword arguments:
+	abort_check	--	A function that returns True if waiting should stop, #
+					for example because a response was collected, or None. #
+					(default=None)
+
+	Returns:
+	True if the deadline has passed or abort_check() returns True, False #
+	otherwise.
+	"""
+
+	if deadline != None and default_timer() >= deadline:
+		return True
+	return abort_check != None and bool(abort_check())
+
+class poll_scheduler:
+
+	"""
+	Decides how long to wait before polling a tracker again. Most of the time
+	until the next sample is due is slept away, and only the final fraction is
+	spent spinning, so that a new sample is picked up almost immediately
+	without occupying the CPU for the whole sample interval.
+	"""
+
+	def __init__(self, interval, spin=.2):
+
+		"""
+		Constructor.
+
+		Arguments:
+		interval	--	The time between two samples in ms.
+
+		Keyword arguments:
+		spin		--	The fraction of the sample interval that is spent #
+						spinning before, and after, the moment at which the #
+						next sample is due. (default=.2)
+		"""
+
+		self.spin = spin
+		self.set_interval(interval)
+		self.last = None
+		self.timer_resolution = False
+
+	def set_interval(self, interval):
+
+		"""
+		Sets the time between two samples.
+
+		Arguments:
+		interval	--	The time between two samples in ms.
+		"""
+
+		self.interval = interval / 1000.
+		self.spinwindow = max(self.interval * self.spin, SLEEP_GRANULARITY)
+
+	def arrived(self, t=None):
+
+		"""
+		Indicates that a new sample has arrived.
+
+		Keyword arguments:
+		t	--	The arrival time according to timeit.default_timer, or None #
+				for now. (default=None)
+		"""
+
+		if t == None:
+			t = default_timer()
+		self.last = t
+
+	def pause(self, deadline=None):
+
+		"""
+		Waits before the next poll. Until shortly before the next sample is #
+		due, this sleeps. Around the moment that the sample is due, this only #
+		yields to other threads, so that the caller spins. If the sample is #
+		late, for example because the tracker is stalling, this sleeps for a #
+		fraction of the sample interval, so that waiting remains cheap.
+
+		Keyword arguments:
+		deadline	--	A time according to timeit.default_timer beyond #
+						which the caller doesn't want to sleep, or None for #
+						no limit. (default=None)
+		"""
+
+		now = default_timer()
+		if self.last == None:
+			due = now
+		else:
+			due = self.last + self.interval
+		if now < due - self.spinwindow:
+			delay = due - self.spinwindow - now
+		elif now < due + self.spinwindow:
+			delay = 0
+		else:
+			delay = self.spinwindow
+		if deadline != None:
+			delay = min(delay, deadline - now)
+		if delay >= SLEEP_GRANULARITY:
+			time.sleep(delay)
+		else:
+			# Yield to other threads, such as the acquisition thread
+			time.sleep(0)
+
+	def start(self):
+
+		"""
+		Raises the system timer resolution to 1 ms, so that short sleeps are #
+		accurate. This only has an effect on Windows.
+		"""
+
+		if sys.platform == 'win32' and not self.timer_resolution:
+			import ctypes
+			try:
+				ctypes.windll.winmm.timeBeginPeriod(1)
+			except Exception as e:
+				print u'pollscheduler: failed to set timer resolution (%s)' % e
+			else:
+				self.timer_resolution = True
+
+	def stop(self):
+
+		"""Restores the system timer resolution that was changed by start()."""
+
+		if self.timer_resolution:
+			import ctypes
+			ctypes.windll.winmm.timeEndPeriod(1)
+			self.timer_resolution = False
@@ -0,0 +1,517 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ctypes
+import threading
+import time
+import numpy
+
+# The layout of a single buffered sample. The timestamp is in tracker time
+# (ms), the eye is 0 (left) or 1 (right), valid is False for missing data and
+# exptime is the timestamp converted to experiment time (ms).
+SAMPLE_DTYPE = numpy.dtype([
+	('timestamp', numpy.float64),
+	('x', numpy.float64),
+	('y', numpy.float64),
+	('pupil', numpy.float64),
+	('eye', numpy.int8),
+	('valid', numpy.bool_),
+	('exptime', numpy.float64)
+	])
+
+def struct_dtype(struct_type):
+
+	"""
+	Creates a numpy dtype with the same memory layout as a ctypes struct, #
+	including nested structs and padding.
+
+	Arguments:
+	struct_type	--	A ctypes.Structure subclass.
+
+	Returns:
+	A numpy dtype.
+	"""
+
+	names = []
+	formats = []
+	offsets = []
+	for name, ctype in struct_type._fields_:
+		names.append(name)
+		if issubclass(ctype, ctypes.Structure):
+			formats.append(struct_dtype(ctype))
+		else:
+			formats.append(numpy.dtype(ctype))
+		offsets.append(getattr(struct_type, name).offset)
+	return numpy.dtype({'names': names, 'formats': formats, \
+		'offsets': offsets, 'itemsize': ctypes.sizeof(struct_type)})
+
+class sample_record(object):
+
+	"""
+	A single sample, as returned by the sample_full() function of the trackers.
+	The attributes are declared as slots, which keeps the record small and
+	cheap to create.
+	"""
+
+	__slots__ = ('timestamp', 'x', 'y', 'pupil', 'eye', 'valid', 'exptime')
+
+	def __init__(self, timestamp, x, y, pupil=-1, eye=0, valid=True, \
+		exptime=None):
+
+		"""
+		Constructor. The arguments are the same as for sample_buffer.push().
+		"""
+
+		self.timestamp = timestamp
+		self.x = x
+		self.y = y
+		self.pupil = pupil
+		self.eye = eye
+		self.valid = valid
+		if exptime is None:
+			exptime = timestamp
+		self.exptime = exptime
+
+	def __repr__(self):
+
+		return u'sample_record(%s, %s, %s, %s, %s, %s, %s)' % ( \
+			self.timestamp, self.x, self.y, self.pupil, self.eye, self.valid, \
+			self.exptime)
+
+class sample_buffer:
+
+	"""
+	A fixed-size ring buffer of gaze samples. The memory is allocated once, by
+	the constructor, so that pushing a sample never allocates. When the buffer
+	is full, the oldest samples are overwritten.
+	"""
+
+	def __init__(self, size=8192):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		size	--	The number of samples that the buffer can hold. #
+					(default=8192)
+		"""
+
+		self.size = size
+		self.data = numpy.zeros(size, dtype=SAMPLE_DTYPE)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def push(self, timestamp, x, y, pupil=-1, eye=0, valid=True, exptime=None):
+
+		"""
+		Adds a sample to the head of the buffer.
+
+		Arguments:
+		timestamp	--	The tracker timestamp of the sample.
+		x			--	The horizontal gaze position.
+		y			--	The vertical gaze position.
+
+		Keyword arguments:
+		pupil		--	The pupil size. (default=-1)
+		eye			--	The eye that the sample belongs to. (default=0)
+		valid		--	Indicates whether the sample contains valid data. #
+						(default=True)
+		exptime		--	The timestamp in experiment time, or None if the #
+						tracker uses the experiment clock. (default=None)
+		"""
+
+		if exptime is None:
+			exptime = timestamp
+		with self.lock:
+			self.data[self.count % self.size] = \
+				(timestamp, x, y, pupil, eye, valid, exptime)
+			self.count += 1
+
+	def newest(self):
+
+		"""
+		Gets the sample at the head of the buffer.
+
+		Returns:
+		A (timestamp, x, y, pupil, eye, valid, exptime) tuple, or None if the #
+		buffer is empty.
+		"""
+
+		with self.lock:
+			if self.count == 0:
+				return None
+			return self.data[(self.count - 1) % self.size].item()
+
+	def read(self, index):
+
+		"""
+		Gets a sample by its position in the stream, which allows a consumer to #
+		process every sample in order. If the sample has already been #
+		overwritten, the oldest sample that is still available is returned.
+
+		Arguments:
+		index	--	The position of the sample, where 0 is the first sample #
+					that was pushed after the buffer was (last) cleared.
+
+		Returns:
+		An (index, sample) tuple, where index is the actual position of the #
+		sample and sample is a (timestamp, x, y, pupil, eye, valid, exptime) #
+		tuple, or None if no sample has been pushed at the position yet.
+		"""
+
+		with self.lock:
+			if index >= self.count:
+				return None
+			index = max(index, self.count - self.size)
+			return index, self.data[index % self.size].item()
+
+	def window(self, since=None, n=None):
+
+		"""
+		Gets the most recent samples in chronological order.
+
+		Keyword arguments:
+		since	--	A tracker timestamp. Only samples that are more recent are #
+					returned, or None for no limit. (default=None)
+		n		--	The maximum number of samples to return, or None for no #
+					limit. (default=None)
+
+		Returns:
+		A structured numpy array with the SAMPLE_DTYPE layout. This is a copy, #
+		so it is not affected by subsequent pushes.
+		"""
+
+		with self.lock:
+			# The buffer consists of at most two chronological segments: the
+			# oldest samples after the head and the newest samples before it.
+			if self.count <= self.size:
+				segments = [self.data[:self.count]]
+			else:
+				head = self.count % self.size
+				segments = [self.data[head:], self.data[:head]]
+			if since != None:
+				segments = [seg[numpy.searchsorted(seg['timestamp'], since, \
+					side='right'):] for seg in segments]
+			if n != None:
+				tail = []
+				for seg in reversed(segments):
+					if n <= 0:
+						break
+					if len(seg) > n:
+						seg = seg[len(seg) - n:]
+					tail.insert(0, seg)
+					n -= len(seg)
+				segments = tail
+			if len(segments) == 0:
+				return numpy.zeros(0, dtype=SAMPLE_DTYPE)
+			return numpy.concatenate(segments)
+
+	def clear(self):
+
+		"""Empties the buffer, without releasing its memory."""
+
+		with self.lock:
+			self.count = 0
+
+class sample_store:
+
+	"""
+	An append-only array of gaze samples, which keeps every sample that is
+	pushed. Memory is allocated in chunks, so that the array only needs to be
+	reallocated once every chunk samples. The interface is the same as that of
+	sample_buffer.
+	"""
+
+	def __init__(self, chunk=65536):
+
+		"""
+		Constructor.
+
+		Keyword arguments:
+		chunk	--	The number of samples by which the store grows when it is #
+					full. (default=65536)
+		"""
+
+		self.chunk = chunk
+		self.data = numpy.zeros(chunk, dtype=SAMPLE_DTYPE)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def push(self, timestamp, x, y, pupil=-1, eye=0, valid=True, exptime=None):
+
+		"""See sample_buffer.push()."""
+
+		if exptime is None:
+			exptime = timestamp
+		with self.lock:
+			if self.count == len(self.data):
+				data = numpy.zeros(len(self.data) + self.chunk, \
+					dtype=SAMPLE_DTYPE)
+				data[:self.count] = self.data
+				self.data = data
+			self.data[self.count] = (timestamp, x, y, pupil, eye, valid, \
+				exptime)
+			self.count += 1
+
+	def newest(self):
+
+		"""See sample_buffer.newest()."""
+
+		with self.lock:
+			if self.count == 0:
+				return None
+			return self.data[self.count - 1].item()
+
+	def read(self, index):
+
+		"""See sample_buffer.read()."""
+
+		with self.lock:
+			if index >= self.count:
+				return None
+			return index, self.data[index].item()
+
+	def window(self, since=None, n=None):
+
+		"""See sample_buffer.window()."""
+
+		with self.lock:
+			data = self.data[:self.count]
+			if since != None:
+				data = data[numpy.searchsorted(data['timestamp'], since, \
+					side='right'):]
+			if n != None:
+				data = data[max(len(data) - n, 0):]
+			return data.copy()
+
+	def clear(self):
+
+		"""Empties the store, without releasing its memory."""
+
+		with self.lock:
+			self.count = 0
+
+class struct_ring:
+
+	"""
+	A fixed-size ring buffer of ctypes structs, such as the sample structs that #
+	are filled by a tracker API. The structs live in a single contiguous ctypes #
+	array, which is also exposed as a numpy array (without copying), so that #
+	windows of raw samples can be analyzed without creating a Python object #
+	per sample.
+	"""
+
+	def __init__(self, struct_type, size=8192):
+
+		"""
+		Constructor.
+
+		Arguments:
+		struct_type	--	A ctypes.Structure subclass. It should have a #
+						'timestamp' field.
+
+		Keyword arguments:
+		size		--	The number of structs that the ring can hold. #
+						(default=8192)
+		"""
+
+		self.size = size
+		self.structs = (struct_type * size)()
+		self.dtype = struct_dtype(struct_type)
+		self.array = numpy.frombuffer(self.structs, dtype=self.dtype)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def push(self, struct):
+
+		"""
+		Copies a struct to the head of the ring.
+
+		Arguments:
+		struct	--	A struct of the type that was passed to the constructor.
+		"""
+
+		with self.lock:
+			self.structs[self.count % self.size] = struct
+			self.count += 1
+
+	def struct(self, index):
+
+		"""
+		Gets a struct by its position in the stream, in the same way as #
+		sample_buffer.read().
+
+		Arguments:
+		index	--	The position of the struct.
+
+		Returns:
+		An (index, struct) tuple, or None if no struct has been pushed at the #
+		position yet. The struct refers to the memory of the ring.
+		"""
+
+		with self.lock:
+			if index >= self.count:
+				return None
+			index = max(index, self.count - self.size)
+			return index, self.structs[index % self.size]
+
+	def raw_window(self, since=None, n=None):
+
+		"""
+		Gets the most recent structs in chronological order, as a structured #
+		numpy array.
+
+		Keyword arguments:
+		since	--	Only structs with a larger 'timestamp' field are #
+					returned, or None for no limit. (default=None)
+		n		--	The maximum number of structs to return, or None for no #
+					limit. (default=None)
+
+		Returns:
+		A structured numpy array. If the structs are contiguous in the ring, #
+		this is a view, which is overwritten when the ring wraps around; #
+		otherwise it is a copy.
+		"""
+
+		with self.lock:
+			if self.count <= self.size:
+				segments = [self.array[:self.count]]
+			else:
+				head = self.count % self.size
+				segments = [self.array[head:], self.array[:head]]
+			if since != None:
+				segments = [seg[numpy.searchsorted(seg['timestamp'], since, \
+					side='right'):] for seg in segments]
+			if n != None:
+				tail = []
+				for seg in reversed(segments):
+					if n <= 0:
+						break
+					if len(seg) > n:
+						seg = seg[len(seg) - n:]
+					tail.insert(0, seg)
+					n -= len(seg)
+				segments = tail
+			segments = [seg for seg in segments if len(seg) > 0]
+			if len(segments) == 0:
+				return self.array[:0]
+			if len(segments) == 1:
+				return segments[0]
+			return numpy.concatenate(segments)
+
+	def clear(self):
+
+		"""Empties the ring, without releasing its memory."""
+
+		with self.lock:
+			self.count = 0
+
+class acquisition_thread(threading.Thread):
+
+	"""
+	Polls a tracker in the background and pushes every new sample into a
+	sample_buffer, so that the main loop only needs to read the head of the
+	buffer. Only the newest sample is polled, so samples can be missed when
+	the thread isn't scheduled in time; these are counted from the gaps
+	between the timestamps.
+	"""
+
+	def __init__(self, poll, buffer, interval=.0005, sampletime=None):
+
+		"""
+		Constructor.
+
+		Arguments:
+		poll		--	A function that returns the newest sample as a #
+						(timestamp, x, y, pupil, eye, valid, exptime) tuple, #
+						or None if no sample is available.
+		buffer		--	The sample_buffer to fill.
+
+		Keyword arguments:
+		interval	--	The time between two polls in seconds. #
+						(default=.0005)
+		sampletime	--	The time between two samples in ms, which is used #
+						to count the missed samples, or None to not count #
+						them. (default=None)
+		"""
+
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.poll = poll
+		self.buffer = buffer
+		self.interval = interval
+		self.sampletime = sampletime
+		self.dropped = 0
+		self.stop_event = threading.Event()
+
+	def run(self):
+
+		"""Polls until stop() is called."""
+
+		last_timestamp = None
+		while not self.stop_event.is_set():
+			s = self.poll()
+			# Only push samples that we haven't seen before
+			if s != None and s[0] != last_timestamp:
+				# A gap of more than one and a half sample times means that
+				# at least one sample was skipped
+				if self.sampletime != None and last_timestamp != None:
+					self.dropped += max(0, int(round((s[0] - last_timestamp) \
+						/ self.sampletime)) - 1)
+				self.buffer.push(*s)
+				last_timestamp = s[0]
+			time.sleep(self.interval)
+
+	def stop(self):
+
+		"""Stops polling and waits for the thread to finish."""
+
+		self.stop_event.set()
+		self.join()
+
+class drain_thread(acquisition_thread):
+
+	"""
+	Repeatedly calls a function that drains a tracker's data queue, and which
+	takes care of storing the data itself. This is used when every sample needs
+	to be kept, rather than only the newest one.
+	"""
+
+	def __init__(self, drain, interval=.0005):
+
+		"""
+		Constructor.
+
+		Arguments:
+		drain		--	A function that reads all queued data and returns #
+						the number of items that were read.
+
+		Keyword arguments:
+		interval	--	The time to sleep when the queue is empty, in #
+						seconds. (default=.0005)
+		"""
+
+		acquisition_thread.__init__(self, None, None, interval=interval)
+		self.drain = drain
+
+	def run(self):
+
+		"""Drains until stop() is called."""
+
+		while not self.stop_event.is_set():
+			if self.drain() == 0:
+				time.sleep(self.interval)
@@ -17,6 +17,8 @@ along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 
 from libopensesame import item, exceptions
 from libqtopensesame import qtplugin
+from openexp.keyboard import keyboard
+from openexp.mouse import mouse
 import os.path
 from PyQt4 import QtGui, QtCore
 
@@ -44,7 +46,18 @@ class eyetracker_wait(item.item):
 		self._sblink = "Blink start"
 		self._eblink = "Blink end"
 		
+		self._none = "None"
+		
 		self.event = self._ssacc
+		self.or_event = self._none
+		
+		self._resp_none = "None"
+		self._resp_keyboard = "Keyboard"
+		self._resp_mouse = "Mouse"
+		self._resp_both = "Keyboard or mouse"
+		
+		self.timeout = "infinite"
+		self.response_device = self._resp_none
 		
 		# Provide a short accurate description of the items functionality
 		self.description = "Wait for event (part of the eyetracker plug-ins)"
@@ -68,20 +81,42 @@ class eyetracker_wait(item.item):
 			raise exceptions.runtime_error("Please connect to the eyetracker using the the eyetracker_calibrate plugin before using any other eyetracker plugins")
 		
 		# Use static numbers to avoid importing pylink			
-		if self.event == self._ssacc:
-			self._event = 5 #pylink.STARTSACC
-		elif self.event == self._esacc:
-			self._event = 6 #pylink.ENDSACC
-		elif self.event == self._sfix:
-			self._event = 7 #pylink.STARTFIX
-		elif self.event == self._efix:
-			self._event = 8 #pylink.ENDFIX
-		elif self.event == self._sblink:
-			self._event = 3 #pylink.STARTBLINK
-		elif self.event == self._eblink:
-			self._event = 4 #pylink.ENDBLINK
-		else:
+		self._codes = {
+			self._ssacc : 5, #pylink.STARTSACC
+			self._esacc : 6, #pylink.ENDSACC
+			self._sfix : 7, #pylink.STARTFIX
+			self._efix : 8, #pylink.ENDFIX
+			self._sblink : 3, #pylink.STARTBLINK
+			self._eblink : 4 #pylink.ENDBLINK
+			}
+		if self.event not in self._codes:
 			raise exceptions.runtime_error("An unknown event was specified in eyetracker_wait item '%s'" % self.name)										
+		self._events = [self._codes[self.event]]
+		
+		# An optional second event, which is waited for at the same time
+		if self.get("or_event") != self._none:
+			if self.get("or_event") not in self._codes:
+				raise exceptions.runtime_error("An unknown event was specified in eyetracker_wait item '%s'" % self.name)
+			if self._codes[self.get("or_event")] not in self._events:
+				self._events.append(self._codes[self.get("or_event")])
+		
+		# The timeout in milliseconds, or None to wait indefinitely
+		if self.get("timeout") == "infinite":
+			self._timeout = None
+		else:
+			try:
+				self._timeout = float(self.get("timeout"))
+			except ValueError:
+				raise exceptions.runtime_error("The timeout in eyetracker_wait item '%s' should be a number of milliseconds or 'infinite'" % self.name)
+		
+		# Responses are collected in the same polling loop as the eyetracker
+		# event, so the devices are polled without a timeout
+		self._keyboard = None
+		self._mouse = None
+		if self.get("response_device") in (self._resp_keyboard, self._resp_both):
+			self._keyboard = keyboard(self.experiment, timeout=0)
+		if self.get("response_device") in (self._resp_mouse, self._resp_both):
+			self._mouse = mouse(self.experiment, timeout=0)
 				
 		# Report success
 		return True
@@ -93,11 +128,67 @@ class eyetracker_wait(item.item):
 		to the display and waiting for the specified duration.
 		"""
 		
-		self.experiment.eyetracker.wait_for_event(self._event)	
+		self._response = None
+		if self._keyboard != None:
+			self._keyboard.flush()
+		if self._mouse != None:
+			self._mouse.flush()
+		if self._keyboard != None or self._mouse != None:
+			abort_check = self._check_response
+		else:
+			abort_check = None
+		
+		# Whichever comes first ends the item: the event, a response or the
+		# timeout
+		t0 = self.experiment.time()
+		outcome = self.experiment.eyetracker.wait_for_any(self._events, \
+			timeout=self._timeout, abort_check=abort_check)
 		self.set_item_onset()
+		event = "NA"
+		if outcome != None:
+			# The latency is that of the event itself, rather than the moment
+			# at which it was noticed. The outcome of blinks on SMI trackers
+			# is only a time, and a tuple that starts with the time otherwise.
+			t1 = outcome[1]
+			if isinstance(t1, tuple):
+				t1 = t1[0]
+			result, response = "event", "NA"
+			for name, code in self._codes.items():
+				if code == outcome[0]:
+					event = name
+		elif self._response != None:
+			result, response, t1 = self._response
+		else:
+			result, response, t1 = "timeout", "NA", self.experiment.time()
+		self.experiment.set("eyetracker_outcome", result)
+		self.experiment.set("eyetracker_event", event)
+		self.experiment.set("eyetracker_response", response)
+		self.experiment.set("eyetracker_latency", t1 - t0)
 				
 		# Report success
 		return True
+		
+	def _check_response(self):
+	
+		"""
+		Checks whether a keyboard or mouse response has been given. This is
+		called repeatedly by the eyetracker while it waits for the event.
+		
+		Returns:
+		True if a response has been given, False otherwise.
+		"""
+		
+		if self._keyboard != None:
+			key, t = self._keyboard.get_key(timeout=0)
+			if key != None:
+				self._response = "keyboard", key, t
+				return True
+		if self._mouse != None:
+			button, pos, t = self._mouse.get_click(timeout=0)
+			if button != None:
+				self._response = "mouse", button, t
+				return True
+		return False
 					
 class qteyetracker_wait(eyetracker_wait, qtplugin.qtplugin):
 
@@ -131,6 +222,9 @@ class qteyetracker_wait(eyetracker_wait, qtplugin.qtplugin):
 		# Pass the word on to the parent		
 		qtplugin.qtplugin.init_edit_widget(self, False)			
 		self.add_combobox_control("event", "Event", [self._ssacc, self._esacc, self._sfix, self._efix, self._sblink, self._eblink], tooltip = "The eyetracker event to wait for")
+		self.add_combobox_control("or_event", "Or event", [self._none, self._ssacc, self._esacc, self._sfix, self._efix, self._sblink, self._eblink], tooltip = "Another eyetracker event that also ends the item")
+		self.add_line_edit_control("timeout", "Timeout", tooltip = "The maximum waiting time in milliseconds, or 'infinite'")
+		self.add_combobox_control("response_device", "Response", [self._resp_none, self._resp_keyboard, self._resp_mouse, self._resp_both], tooltip = "A response device that can also end the item")
 		
 		# Add a stretch to the edit_vbox, so that the controls do not
 		# stretch to the bottom of the window.